@@ -0,0 +1,477 @@
+"""Нагрузочный тест бота без настоящего Telegram.
+
+Поднимает заглушку Bot API (задержка и 429 настраиваются), запускает main.py
+отдельным процессом на временной базе, засевает пользователей и вопросы и гоняет
+синтетические апдейты через /webhook и открытия Mini App. Печатает апдейты/с,
+p50/p95/p99 задержки и рост базы по каждому сценарию.
+
+    python loadtest.py --scenario small
+    python loadtest.py --scenario 10k-users --scenario 10k-users-1m-questions --workers 4
+    python loadtest.py --users 2000 --questions 50000 --ops 5000 --api-latency 0.05 --api-429 0.01
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+TOKEN = "123456:LOADTEST-TOKEN"
+BOT_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# имя -> (пользователей, вопросов в базе заранее, операций за прогон)
+SCENARIOS = {
+    "small": (1000, 10000, 5000),
+    "10k-users": (10000, 100000, 20000),
+    "10k-users-1m-questions": (10000, 1000000, 20000),
+}
+
+# Доли действий виртуального пользователя
+ACTIONS = {"start": 0.10, "ask": 0.35, "reply": 0.20, "like": 0.10, "pay": 0.05, "miniapp": 0.20}
+
+# Сообщения, которые бот шлёт чату не в ответ на его собственный апдейт.
+# «⏳ Готовим PDF» — ответ на оплату, а сам PDF приходит позже и ждётся отдельно
+SIDE_EFFECTS = ("Новый анонимный вопрос", "Тебе ", "🎉 Приглашено друзей", "✅ Ваш PDF")
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def file_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class FakeBotAPI:
+    """Отвечает как Telegram: sendMessage, sendInvoice, setWebhook и т.п.
+
+    Запоминает доставленные вопросы и ответы, чтобы генератор мог на них
+    реплаить, и будит виртуального пользователя, когда бот ответил в его чат.
+    """
+
+    MESSAGE_METHODS = {"sendMessage", "sendInvoice", "sendDocument", "sendPhoto", "editMessageText", "copyMessage"}
+
+    def __init__(self, latency: float = 0.0, rate_429: float = 0.0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.message_ids = itertools.count(1_000_000)
+        self.calls = Counter()
+        self.throttled = 0
+        self.questions = {}  # chat_id -> [(message_id, text)] пришедших вопросов
+        self.answers = {}    # chat_id -> [(message_id, text)] пришедших ответов
+        self.question_ids = {}  # chat_id -> [id вопроса] из кнопки «Поднять в топ»
+        self.waiters = {}    # chat_id -> Future с моментом ответа бота
+        self.documents = {}  # chat_id -> Future, которая сработает на sendDocument
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.rate_429 and method != "setWebhook" and random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        return web.json_response({"ok": True, "result": self.result(method, data)})
+
+    def result(self, method: str, data: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Load", "username": "load_bot"}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method not in self.MESSAGE_METHODS or "chat_id" not in data:
+            return True
+
+        chat_id = int(data["chat_id"])
+        text = data.get("text") or data.get("caption") or ""
+        message_id = next(self.message_ids)
+        if text.startswith("Новый анонимный вопрос"):
+            self.questions.setdefault(chat_id, []).append((message_id, text))
+            for row in json.loads(data.get("reply_markup") or "{}").get("inline_keyboard", []):
+                for button in row:
+                    if button.get("callback_data", "").startswith("bump_question:"):
+                        self.question_ids.setdefault(chat_id, []).append(int(button["callback_data"].split(":")[1]))
+        elif text.startswith("Тебе ") and "анонимно:" in text:  # сам ответ, а не пуш о нём
+            self.answers.setdefault(chat_id, []).append((message_id, text))
+        if method == "sendDocument":
+            document = self.documents.pop(chat_id, None)
+            if document is not None and not document.done():
+                document.set_result(time.perf_counter())
+        if not text.startswith(SIDE_EFFECTS):
+            waiter = self.waiters.pop(chat_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+# ==================== ГЕНЕРАТОР АПДЕЙТОВ ====================
+def init_data(user_id: int) -> str:
+    """initData Mini App, подписанная так же, как это делает Telegram"""
+    fields = {"auth_date": str(int(time.time())), "query_id": "LOAD",
+              "user": json.dumps({"id": user_id, "first_name": "load", "username": f"load{user_id}"})}
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+class LoadGenerator:
+    """Виртуальные пользователи: каждый ждёт ответа бота перед следующим апдейтом"""
+
+    def __init__(self, api: FakeBotAPI, base_url: str, users: int, ops: int,
+                 concurrency: int, timeout: float):
+        self.api = api
+        self.base_url = base_url
+        self.population = list(range(1, users + 1))
+        self.next_user = users + 1
+        self.ops = ops
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.charges = itertools.count(1)
+        self.busy = set()
+        self.started = 0
+        self.ack = []       # время ответа /webhook
+        self.e2e = []       # от POST до ответа бота в чат
+        self.miniapp = []   # GET /miniapp + GET /api/me + GET /api/inbox
+        self.actions = Counter()
+        self.lost = Counter()  # действие -> апдейты без ответа бота
+        self.current = {}      # user_id -> текущее действие
+        self.completed = self.timeouts = self.rejected = 0
+
+    def message(self, user_id: int, text=None, **extra) -> dict:
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": "load", "username": f"load{user_id}"}}
+        if text is not None:
+            message["text"] = text
+        message.update(extra)
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "chat_instance": "load", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "load", "username": f"load{user_id}"},
+            "message": {"message_id": next(self.message_ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "text": "menu"},
+        }}
+
+    async def send(self, user_id: int, update: dict) -> bool:
+        waiter = asyncio.get_running_loop().create_future()
+        self.api.waiters[user_id] = waiter
+        start = time.perf_counter()
+        async with self.http.post(f"{self.base_url}/webhook", json=update) as response:
+            await response.read()
+        self.ack.append(time.perf_counter() - start)
+        if response.status != 200:
+            self.rejected += 1
+            self.api.waiters.pop(user_id, None)
+            return False
+        try:
+            done = await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.lost[self.current.get(user_id, "?")] += 1
+            self.api.waiters.pop(user_id, None)
+            return False
+        self.e2e.append(done - start)
+        self.completed += 1
+        return True
+
+    async def do_start(self, _):
+        user_id = self.next_user
+        self.next_user += 1
+        self.busy.add(user_id)
+        try:
+            ref = f" {random.choice(self.population)}" if random.random() < 0.5 else ""
+            if await self.send(user_id, self.message(user_id, f"/start{ref}")):
+                self.population.append(user_id)
+        finally:
+            self.busy.discard(user_id)
+
+    async def do_ask(self, user_id: int):
+        target = random.choice(self.population)
+        text = f"Вопрос от нагрузочного теста {random.randint(1, 10**9)} " + "текст " * random.randint(1, 30)
+        if await self.send(user_id, self.callback(user_id, "ask")):
+            if await self.send(user_id, self.message(user_id, f"@load{target}")):
+                await self.send(user_id, self.message(user_id, text))
+
+    async def do_reply(self, user_id: int):
+        inbox = self.api.questions.get(user_id)
+        if not inbox:
+            return await self.do_ask(user_id)
+        message_id, text = inbox.pop(random.randrange(len(inbox)))
+        await self.send(user_id, self.message(
+            user_id, f"Ответ {random.randint(1, 10**9)}",
+            reply_to_message={"message_id": message_id, "date": int(time.time()),
+                              "chat": {"id": user_id, "type": "private"}, "text": text},
+        ))
+
+    async def do_like(self, user_id: int):
+        inbox = self.api.answers.get(user_id) or self.api.questions.get(user_id)
+        if not inbox:
+            return await self.do_ask(user_id)
+        message_id, text = random.choice(inbox)
+        await self.send(user_id, self.message(
+            user_id, "❤️",
+            reply_to_message={"message_id": message_id, "date": int(time.time()),
+                              "chat": {"id": user_id, "type": "private"}, "text": text},
+        ))
+
+    async def do_pay(self, user_id: int):
+        payload, stars = random.choice([
+            ("month", 135), ("3month", 330), ("life", 2600), ("bump", 1), ("hidden", 3), ("pdf", 10),
+        ])
+        if payload == "bump":
+            # Поднять можно только свой входящий вопрос — id берём из кнопки под ним
+            received = self.api.question_ids.get(user_id)
+            if not received:
+                payload, stars = "hidden", 3
+            else:
+                payload = f"bump:{random.choice(received)}"
+        document = None
+        if payload == "pdf":
+            document = self.api.documents[user_id] = asyncio.get_running_loop().create_future()
+        paid = await self.send(user_id, self.message(user_id, successful_payment={
+            "currency": "XTR", "total_amount": stars * 100, "invoice_payload": payload,
+            "telegram_payment_charge_id": f"load-{next(self.charges)}", "provider_payment_charge_id": "load",
+        }))
+        if document is None:
+            return
+        # Оплаченный PDF должен прийти документом; «не удалось собрать» — тоже потеря
+        try:
+            if paid:
+                await asyncio.wait_for(document, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.lost["pay:pdf"] += 1
+        finally:
+            self.api.documents.pop(user_id, None)
+
+    async def do_miniapp(self, user_id: int):
+        start = time.perf_counter()
+        async with self.http.get(f"{self.base_url}/miniapp") as response:
+            await response.read()
+        headers = {"X-Telegram-Init-Data": init_data(user_id)}
+        async with self.http.get(f"{self.base_url}/api/me", headers=headers) as response:
+            await response.read()
+        async with self.http.get(f"{self.base_url}/api/inbox", headers=headers) as inbox:
+            await inbox.read()
+        if response.status == 200 and inbox.status == 200:
+            self.miniapp.append(time.perf_counter() - start)
+
+    async def virtual_user(self):
+        names, weights = zip(*ACTIONS.items())
+        while self.started < self.ops:
+            self.started += 1
+            action = random.choices(names, weights)[0]
+            user_id = random.choice(self.population)
+            if user_id in self.busy:
+                continue
+            self.busy.add(user_id)
+            self.actions[action] += 1
+            self.current[user_id] = action
+            try:
+                await getattr(self, f"do_{action}")(user_id)
+            except Exception as e:
+                print(f"❌ {action} для {user_id}: {e}")
+            finally:
+                self.busy.discard(user_id)
+                self.current.pop(user_id, None)
+
+    async def run(self) -> float:
+        timeout = ClientTimeout(total=self.timeout + 5)
+        async with ClientSession(timeout=timeout) as self.http:
+            start = time.perf_counter()
+            await asyncio.gather(*(self.virtual_user() for _ in range(self.concurrency)))
+            return time.perf_counter() - start
+
+# ==================== СЦЕНАРИЙ ====================
+def bot_env(workdir: str, bot_port: int, api_port: int, workers: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        "RENDER_EXTERNAL_URL": f"http://127.0.0.1:{bot_port}",
+        "PORT": str(bot_port),
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "FSM_DB_PATH": os.path.join(workdir, "fsm.db"),
+        "ARCHIVE_DB_PATH": os.path.join(workdir, "archive.db"),
+        "EXPORT_DIR": os.path.join(workdir, "exports"),
+        "WORKERS": str(workers),
+    })
+    return env
+
+def seed(db_path: str, users: int, questions: int, chunk: int = 50000):
+    """Пользователи load1..loadN и вопросы со смещением к популярным получателям"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, trial_until_ts) VALUES (?, ?, ?)",
+        ((user_id, f"load{user_id}", now + 3 * 86400) for user_id in range(1, users + 1))
+    )
+    for offset in range(0, questions, chunk):
+        rows = []
+        for _ in range(min(chunk, questions - offset)):
+            to_user = min(int(random.paretovariate(1.2)), users)
+            answered = random.random() < 0.5
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - random.randint(0, 30 * 86400)))
+            rows.append((random.randint(1, users), to_user, "Засеянный вопрос " + "текст " * random.randint(1, 20),
+                         "Засеянный ответ" if answered else None, int(answered), created))
+        conn.executemany(
+            "INSERT INTO questions (from_user, to_user, text, answer, answered, notified, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?)", rows
+        )
+        conn.commit()
+    conn.close()
+
+def run_cli(env: dict, command: str, log):
+    subprocess.run([sys.executable, BOT_PY, command], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(url: str, proc, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    async with ClientSession(timeout=ClientTimeout(total=2)) as http:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"бот завершился с кодом {proc.returncode}")
+            try:
+                async with http.get(f"{url}/readyz") as response:
+                    if response.status == 200:
+                        return
+            except Exception:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("бот не поднялся вовремя")
+
+async def run_scenario(name: str, users: int, questions: int, ops: int, args) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"loadtest-{name}-")
+    api_port, bot_port = free_port(), free_port()
+    env = bot_env(workdir, bot_port, api_port, args.workers)
+    db_path = env["DB_PATH"]
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    print(f"⏳ {name}: засеваем {users} пользователей и {questions} вопросов в {workdir}")
+
+    run_cli(env, "check-plans", log)  # заодно создаёт схему
+    started = time.perf_counter()
+    seed(db_path, users, questions)
+    run_cli(env, "rebuild-stats", log)
+    print(f"✅ {name}: засеяно за {time.perf_counter() - started:.1f}с, база {file_size(db_path) / 2**20:.1f} МБ")
+
+    api = FakeBotAPI(latency=args.api_latency, rate_429=args.api_429)
+    runner = await api.start(api_port)
+    proc = subprocess.Popen([sys.executable, BOT_PY], env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{bot_port}"
+    try:
+        await wait_ready(base_url, proc)
+        size_before = file_size(db_path)
+        generator = LoadGenerator(api, base_url, users, ops, args.concurrency, args.timeout)
+        elapsed = await generator.run()
+        async with ClientSession() as http:
+            async with http.get(f"{base_url}/metrics") as response:
+                with open(os.path.join(workdir, "metrics.txt"), "wb") as f:
+                    f.write(await response.read())
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await runner.cleanup()
+        log.close()
+
+    updates = len(generator.ack)
+    return {
+        "name": name, "users": users, "questions": questions, "elapsed": elapsed,
+        "updates": updates, "completed": generator.completed,
+        "timeouts": generator.timeouts, "rejected": generator.rejected,
+        "rate": generator.completed / elapsed if elapsed else 0,
+        "e2e": [percentile(generator.e2e, p) for p in (50, 95, 99)],
+        "ack": [percentile(generator.ack, p) for p in (50, 95, 99)],
+        "miniapp": [percentile(generator.miniapp, p) for p in (50, 95, 99)],
+        "db_before": size_before, "db_after": file_size(db_path),
+        "api_calls": sum(api.calls.values()), "throttled": api.throttled,
+        "actions": dict(generator.actions), "lost": dict(generator.lost), "workdir": workdir,
+    }
+
+def report(result: dict):
+    ms = lambda values: " / ".join(f"{v * 1000:.1f}" for v in values)
+    print(f"\n📊 {result['name']}: {result['users']} пользователей, {result['questions']} вопросов в базе")
+    print(f"   Апдейтов: {result['updates']} за {result['elapsed']:.1f}с → {result['rate']:.0f} апд/с "
+          f"(обработано {result['completed']}, таймаутов {result['timeouts']}, отказов {result['rejected']})")
+    if result["lost"]:
+        print(f"   Без ответа бота по действиям: {result['lost']}")
+    print(f"   До ответа бота p50/p95/p99, мс: {ms(result['e2e'])}")
+    print(f"   Ответ /webhook p50/p95/p99, мс: {ms(result['ack'])}")
+    print(f"   Mini App p50/p95/p99, мс:       {ms(result['miniapp'])}")
+    print(f"   База: {result['db_before'] / 2**20:.1f} → {result['db_after'] / 2**20:.1f} МБ")
+    print(f"   Bot API: {result['api_calls']} вызовов, 429: {result['throttled']} | действия: {result['actions']}")
+    print(f"   Логи и /metrics: {result['workdir']}")
+
+async def main(args):
+    if args.users:
+        plans = [("custom", args.users, args.questions, args.ops)]
+    else:
+        plans = [(name, *SCENARIOS[name]) for name in (args.scenario or ["small"])]
+    if args.ops and not args.users:
+        plans = [(name, users, questions, args.ops) for name, users, questions, _ in plans]
+
+    results = []
+    for name, users, questions, ops in plans:
+        result = await run_scenario(name, users, questions, ops, args)
+        report(result)
+        results.append(result)
+
+    if len(results) > 1:
+        print("\nсценарий                  апд/с    p50     p95     p99  (мс)   база, МБ")
+        for r in results:
+            p50, p95, p99 = (v * 1000 for v in r["e2e"])
+            print(f"{r['name']:<24} {r['rate']:>6.0f} {p50:>7.1f} {p95:>7.1f} {p99:>7.1f}"
+                  f"   {r['db_before'] / 2**20:.1f} → {r['db_after'] / 2**20:.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушкой Bot API")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="готовый сценарий, можно несколько раз")
+    parser.add_argument("--users", type=int, help="свой сценарий: пользователей в базе")
+    parser.add_argument("--questions", type=int, default=0, help="свой сценарий: вопросов в базе")
+    parser.add_argument("--ops", type=int, help="операций за прогон (апдейты и открытия Mini App)")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных виртуальных пользователей")
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS для бота")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="средняя задержка Bot API, с")
+    parser.add_argument("--api-429", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--timeout", type=float, default=15, help="сколько ждать ответа бота, с")
+    args = parser.parse_args()
+    if args.users and not args.ops:
+        args.ops = 5000
+    asyncio.run(main(args))
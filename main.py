@@ -1,28 +1,40 @@
 import os
+import sys
 import json
+import sqlite3
 import aiosqlite
 import asyncio
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
-from urllib.parse import parse_qs
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qsl
+import base64
+import gzip
 import hmac
+import multiprocessing
+import signal
+import subprocess
+import time
 import hashlib
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import (
     WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton,
-    LabeledPrice, InputFile, Message
+    LabeledPrice, FSInputFile, Message
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.client.default import DefaultBotProperties
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 # ==================== НАСТРОЙКИ ====================
 TOKEN = os.getenv("BOT_TOKEN")
@@ -37,27 +49,623 @@ print(f"✅ Bot token: {TOKEN[:10]}...")
 print(f"✅ Base URL: {BASE_URL}")
 print(f"✅ Owner ID: {OWNER_ID}")
 
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(storage=MemoryStorage())
-DB = "anonbot.db"
+DB = os.getenv("DB_PATH", "anonbot.db")
+DB_READERS = int(os.getenv("DB_READERS", 4))
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", 25))  # лимит Telegram ~30 msg/s, держим запас
+WORKERS = int(os.getenv("WORKERS", 1))  # >1 — апдейты обрабатывают дочерние процессы
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 10000))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", 86400))  # срок жизни initData, сек
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 2))
+PDF_FONT = os.getenv("PDF_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")  # нужен шрифт с кириллицей
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер или заглушка из loadtest.py
+FSM_DB = os.getenv("FSM_DB_PATH", "fsm.db")
+FSM_TTL = int(os.getenv("FSM_TTL", 6 * 3600))  # брошенный диалог «спросить» живёт 6 часов
+ARCHIVE_DB = os.getenv("ARCHIVE_DB_PATH", "anonbot-archive.db")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))  # отвеченные вопросы старше — в архив
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 3600))
+
+# ==================== ХРАНИЛИЩЕ FSM ====================
+class SQLiteStorage(BaseStorage):
+    """FSM в отдельном файле SQLite с write-through кэшем в памяти.
+
+    Состояние и данные лежат в одной строке: state + компактный JSON + срок жизни.
+    Кэш процесса корректен, пока апдейты одного пользователя обрабатывает один
+    процесс (см. шардирование воркеров по user_id).
+    """
+
+    def __init__(self, path: str, ttl: int = 6 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.cache = {}  # ключ -> [state, data, expires_at]
+        self._conn = None
+        self._open_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    async def _db(self):
+        if self._conn is None:
+            async with self._open_lock:
+                if self._conn is None:
+                    conn = await aiosqlite.connect(self.path)
+                    await conn.execute("PRAGMA journal_mode=WAL")
+                    await conn.execute("PRAGMA synchronous=NORMAL")
+                    await conn.execute("PRAGMA busy_timeout=5000")
+                    await conn.execute("""
+                        CREATE TABLE IF NOT EXISTS fsm (
+                            key TEXT PRIMARY KEY,
+                            state TEXT,
+                            data TEXT,
+                            expires_at INT NOT NULL
+                        ) WITHOUT ROWID
+                    """)
+                    await conn.commit()
+                    self._conn = conn
+        return self._conn
+
+    async def _load(self, key: str) -> list:
+        entry = self.cache.get(key)
+        now = time.time()
+        if entry is None:
+            db = await self._db()
+            row = await (await db.execute("SELECT state, data, expires_at FROM fsm WHERE key = ?", (key,))).fetchone()
+            entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]] if row else [None, {}, 0]
+            self.cache[key] = entry
+        if entry[0] is not None or entry[1]:
+            if entry[2] < now:
+                entry[0], entry[1] = None, {}
+        return entry
+
+    async def _save(self, key: str, entry: list):
+        db = await self._db()
+        if entry[0] is None and not entry[1]:
+            self.cache.pop(key, None)
+            await db.execute("DELETE FROM fsm WHERE key = ?", (key,))
+        else:
+            entry[2] = int(time.time()) + self.ttl
+            data = json.dumps(entry[1], separators=(",", ":"), ensure_ascii=False) if entry[1] else None
+            await db.execute(
+                "INSERT OR REPLACE INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                (key, entry[0], data, entry[2])
+            )
+        await db.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        entry = await self._load(k)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._save(k, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self._key(key)
+        entry = await self._load(k)
+        entry[1] = dict(data)
+        await self._save(k, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key)))[1])
+
+    async def sweep(self):
+        """Удаляет истёкшие состояния из файла и из кэша"""
+        now = int(time.time())
+        db = await self._db()
+        cur = await db.execute("DELETE FROM fsm WHERE expires_at < ?", (now,))
+        await db.commit()
+        self.cache = {k: e for k, e in self.cache.items() if e[2] >= now}
+        return cur.rowcount
+
+    async def sweeper(self, interval: float = 600):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    print(f"✅ FSM: удалено брошенных состояний: {removed}")
+            except Exception as e:
+                print(f"❌ Ошибка очистки FSM: {e}")
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+fsm_storage = SQLiteStorage(FSM_DB, ttl=FSM_TTL)
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode="HTML"),
+)
+dp = Dispatcher(storage=fsm_storage)
 
 # ==================== ПРОВЕРКА ПОДПИСИ TELEGRAM WEB APP ====================
-def verify_telegram_webapp_data(init_data: str, bot_token: str) -> bool:
-    """Проверка подписи Telegram Web App"""
+@dataclass(frozen=True)
+class WebAppUser:
+    """Пользователь Mini App из проверенного initData"""
+    id: int
+    first_name: str = ""
+    last_name: str = ""
+    username: str = ""
+    language_code: str = ""
+    is_premium: bool = False
+    auth_date: int = 0
+
+class WebAppAuth:
+    """Проверка подписи Telegram Web App.
+
+    Секрет из токена считается один раз; проверенный initData кэшируется до
+    истечения auth_date + max_age, так что повторные открытия и API-запросы
+    не пересчитывают HMAC.
+    """
+
+    def __init__(self, bot_token: str, max_age: int = 86400, cache_size: int = 10000, max_skew: int = 60):
+        self.secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        self.max_age = max_age
+        self.max_skew = max_skew  # расхождение часов с Telegram, на которое auth_date может быть в будущем
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # init_data -> WebAppUser
+
+    def verify(self, init_data: str) -> Optional[WebAppUser]:
+        if not init_data:
+            return None
+        now = time.time()
+        user = self.cache.get(init_data)
+        if user is not None:
+            if now - user.auth_date > self.max_age:
+                del self.cache[init_data]
+                return None
+            self.cache.move_to_end(init_data)
+            return user
+
+        try:
+            fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+            hash_str = fields.pop("hash", "")
+            data_check_string = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+            calculated_hash = hmac.new(self.secret, data_check_string.encode(), hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(calculated_hash, hash_str):
+                return None
+
+            auth_date = int(fields.get("auth_date", 0))
+            if now - auth_date > self.max_age or auth_date > now + self.max_skew:
+                return None
+
+            data = json.loads(fields.get("user") or "{}")
+            user = WebAppUser(
+                id=int(data["id"]),
+                first_name=data.get("first_name", ""),
+                last_name=data.get("last_name", ""),
+                username=data.get("username", ""),
+                language_code=data.get("language_code", ""),
+                is_premium=bool(data.get("is_premium", False)),
+                auth_date=auth_date,
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"❌ Ошибка проверки подписи: {e}")
+            return None
+
+        self.cache[init_data] = user
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return user
+
+webapp_auth = WebAppAuth(TOKEN, max_age=WEBAPP_AUTH_MAX_AGE)
+
+def webapp_auth_required(handler):
+    """Передаёт в обработчик проверенного WebAppUser вторым аргументом.
+
+    initData берётся из заголовка X-Telegram-Init-Data или из query string.
+    """
+    async def wrapper(request: web.Request):
+        init_data = request.headers.get("X-Telegram-Init-Data") or request.query_string
+        user = webapp_auth.verify(init_data)
+        if user is None:
+            return web.json_response({"error": "unauthorized"}, status=401)
+        return await handler(request, user)
+    return wrapper
+
+# ==================== МЕТРИКИ ====================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS_HELP = {
+    "bot_handler_seconds": "Время обработчика aiogram",
+    "bot_handler_errors_total": "Исключения в обработчиках aiogram",
+    "http_request_seconds": "Время обработки HTTP-запроса",
+    "sqlite_query_seconds": "Время выполнения SQL-выражения",
+    "sqlite_read_wait_seconds": "Ожидание свободного читателя",
+    "sqlite_write_wait_seconds": "Ожидание писателя",
+    "sqlite_write_hold_seconds": "Сколько транзакция держит писателя",
+    "telegram_api_calls_total": "Вызовы Bot API",
+    "telegram_api_errors_total": "Ошибки Bot API",
+    "telegram_api_seconds": "Время вызова Bot API",
+    "event_loop_lag_seconds": "Опоздание event loop",
+    "bot_update_queue_depth": "Апдейты в очереди",
+    "bot_notify_queue_items": "Пуши об ответах в очереди",
+    "bot_export_queue_depth": "PDF-экспорты в очереди",
+    "bot_username_cache_size": "Записей в кэше username",
+    "bot_entitlement_cache_size": "Записей в кэше премиумов",
+    "bot_archived_questions_total": "Вопросы, перенесённые в архив",
+    "sqlite_hot_questions_bytes": "Размер questions с индексами в основном файле",
+    "bot_counter_flushes_total": "Транзакции сброса буфера счётчиков",
+    "bot_counter_increments_total": "Строки, обновлённые сбросом буфера счётчиков",
+}
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса, /metrics в текстовом формате Prometheus.
+
+    Метки — кортеж пар (имя, значение). Запись — словарь и bisect, без блокировок:
+    всё происходит в одном event loop. Воркеры присылают снимки в главный процесс.
+    """
+
+    def __init__(self):
+        self.counters = {}    # (имя, метки) -> значение
+        self.gauges = {}      # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [по корзинам..., +Inf, сумма]
+        self.remote = {}      # процесс -> последний снимок
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, labels: tuple, value: float):
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        hist = self.histograms.get((name, labels))
+        if hist is None:
+            hist = self.histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 2)
+        hist[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        hist[-1] += value
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": [(name, labels, value) for (name, labels), value in self.counters.items()],
+            "gauges": [(name, labels, value) for (name, labels), value in self.gauges.items()],
+            "histograms": [(name, labels, hist) for (name, labels), hist in self.histograms.items()],
+        }
+
+    def render(self) -> str:
+        families = {}  # (имя, тип) -> строки
+        for process, snap in [("main", self.snapshot())] + sorted(self.remote.items()):
+            extra = (("process", process),)
+            for kind in ("counters", "gauges"):
+                for name, labels, value in snap[kind]:
+                    labels = tuple(map(tuple, labels)) + extra
+                    families.setdefault((name, kind[:-1]), []).append(f"{name}{format_labels(labels)} {value}")
+            for name, labels, hist in snap["histograms"]:
+                labels = tuple(map(tuple, labels)) + extra
+                lines = families.setdefault((name, "histogram"), [])
+                total = 0
+                for le, count in zip(LATENCY_BUCKETS + ("+Inf",), hist):
+                    total += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {total}")
+                lines.append(f"{name}_sum{format_labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {total}")
+
+        out = []
+        for (name, kind), lines in families.items():
+            out.append(f"# HELP {name} {METRICS_HELP.get(name, name)}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    async def loop_lag(self, interval: float = 0.5):
+        """Насколько позже положенного просыпается sleep — мера загруженности loop"""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.observe("event_loop_lag_seconds", (), max(time.perf_counter() - start - interval, 0))
+
+    async def reporter(self, link, interval: float = 5):
+        """Воркер: периодически отправляет снимок в главный процесс"""
+        while True:
+            await asyncio.sleep(interval)
+            collect_runtime_gauges()
+            link.send("metrics", self.snapshot())
+
+metrics = Metrics()
+
+def collect_runtime_gauges():
+    """Очереди и кэши процесса — снимаются перед отдачей метрик"""
+    metrics.set("bot_update_queue_depth", (), updates.stats()["depth"])
+    metrics.set("bot_notify_queue_items", (), notifier.stats()["queue_items"])
+    metrics.set("bot_export_queue_depth", (), exporter.queue.qsize())
+    metrics.set("bot_username_cache_size", (), usernames.stats()["size"])
+    metrics.set("bot_entitlement_cache_size", (), entitlements.stats()["size"])
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    collect_runtime_gauges()
+    return web.Response(body=metrics.render().encode(), headers={
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+        "Cache-Control": "no-store",
+    })
+
+_sql_labels = {}
+
+def sql_labels(sql: str) -> tuple:
+    """Метка выражения: имя из HOT_QUERIES или «глагол таблица»; кэшируется по тексту"""
+    labels = _sql_labels.get(sql)
+    if labels is None:
+        label = next((name for name, (query, _) in HOT_QUERIES.items() if query == sql), None)
+        if label is None:
+            code = " ".join(line for line in sql.splitlines() if not line.strip().startswith("--"))
+            words = code.replace("(", " ").replace(";", " ").split() or ["?"]
+            table = next((w for prev, w in zip(words, words[1:])
+                          if prev.upper() in ("FROM", "INTO", "UPDATE", "TABLE", "INDEX", "EXISTS")
+                          and w.upper() not in ("IF", "NOT", "EXISTS")), "")
+            verb = words[0].lower()
+            label = verb if verb == "explain" else f"{verb} {table}".strip()
+        labels = _sql_labels[sql] = (("query", label),)
+    return labels
+
+class TimedConnection:
+    """Обёртка над соединением aiosqlite: время каждого execute по метке запроса"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, sql: str, parameters=None):
+        return aiosqlite.context.Result(self._timed(sql, self.conn.execute(sql, parameters)))
+
+    def executemany(self, sql: str, parameters):
+        return aiosqlite.context.Result(self._timed(sql, self.conn.executemany(sql, parameters)))
+
+    async def _timed(self, sql: str, result):
+        start = time.perf_counter()
+        try:
+            return await result
+        finally:
+            metrics.observe("sqlite_query_seconds", sql_labels(sql), time.perf_counter() - start)
+
+async def handler_metrics(handler, event, data):
+    """Middleware диспетчера: время каждого обработчика по имени функции"""
+    labels = (("handler", data["handler"].callback.__name__),)
+    start = time.perf_counter()
     try:
-        parsed = parse_qs(init_data)
-        hash_str = parsed.pop('hash', [''])[0]
-        data_check_string = '\n'.join(f"{k}={v[0]}" for k in sorted(parsed.keys()))
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        return calculated_hash == hash_str
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", labels, time.perf_counter() - start)
+
+async def telegram_metrics(make_request, bot, method):
+    """Middleware сессии бота: вызовы, ошибки и время Bot API по методу"""
+    labels = (("method", type(method).__name__),)
+    metrics.inc("telegram_api_calls_total", labels)
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
     except Exception as e:
-        print(f"❌ Ошибка проверки подписи: {e}")
-        return False
-        # ==================== БАЗА ДАННЫХ ====================
-async def init_db():
-    async with aiosqlite.connect(DB) as db:
-        await db.executescript('''
+        metrics.inc("telegram_api_errors_total", labels + (("error", type(e).__name__),))
+        raise
+    finally:
+        metrics.observe("telegram_api_seconds", labels, time.perf_counter() - start)
+
+@web.middleware
+async def http_metrics(request: web.Request, handler):
+    resource = request.match_info.route.resource
+    labels = (("path", resource.canonical if resource else "unknown"),)
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        metrics.observe("http_request_seconds", labels, time.perf_counter() - start)
+
+for _name, _observer in dp.observers.items():
+    if _name not in ("update", "error"):
+        _observer.middleware(handler_metrics)
+bot.session.middleware(telegram_metrics)
+
+# ==================== СЛОЙ БАЗЫ ДАННЫХ ====================
+class Database:
+    """Долгоживущие соединения: пул читателей + один сериализованный писатель (WAL).
+
+    Если задан archive, файл архива подключается к каждому соединению как схема
+    archive, а TEMP VIEW questions_all склеивает горячую таблицу с архивной.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str, readers: int = 4, statement_cache: int = 256, archive: str = None):
+        self.path = path
+        self.archive = archive
+        self.readers = readers
+        self.statement_cache = statement_cache
+        self._writer = None
+        self._pool = None
+        self._connections = []
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, readonly: bool = False):
+        # cached_statements — кэш подготовленных выражений sqlite3 на соединение
+        conn = await aiosqlite.connect(self.path, cached_statements=self.statement_cache)
+        if not readonly:
+            # Действует только на новый файл; старый переводит init_db() через VACUUM
+            await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        if self.archive:
+            await conn.execute("ATTACH DATABASE ? AS archive", (self.archive,))
+            if not readonly:
+                await conn.execute("PRAGMA archive.journal_mode=WAL")
+                for statement in split_sql(ARCHIVE_SCHEMA):
+                    await conn.execute(statement)
+                await conn.commit()
+            # TEMP VIEW — до query_only, иначе читатель не сможет его создать
+            await conn.execute(SQL_QUESTIONS_ALL_VIEW)
+        if readonly:
+            await conn.execute("PRAGMA query_only=ON")
+        self._connections.append(conn)
+        return TimedConnection(conn)
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # Писатель открывается первым — он переводит файл в WAL
+        self._writer = await self._connect()
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self._pool.put_nowait(await self._connect(readonly=True))
+        print(f"✅ SQLite: WAL, {self.readers} читателей + 1 писатель")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        async with self._write_lock:
+            for conn in self._connections:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    print(f"❌ Ошибка закрытия соединения: {e}")
+            self._connections.clear()
+            self._writer = None
+            self._pool = None
+        print("✅ Соединения с БД закрыты")
+
+    @asynccontextmanager
+    async def read(self):
+        start = time.perf_counter()
+        conn = await self._pool.get()
+        metrics.observe("sqlite_read_wait_seconds", (), time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Одна транзакция на писателе: commit при успехе, rollback при ошибке"""
+        start = time.perf_counter()
+        async with self._write_lock:
+            acquired = time.perf_counter()
+            metrics.observe("sqlite_write_wait_seconds", (), acquired - start)
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                metrics.observe("sqlite_write_hold_seconds", (), time.perf_counter() - acquired)
+
+    async def fetchone(self, sql: str, params=()):
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+    async def execute(self, sql: str, params=()):
+        async with self.write() as db:
+            cur = await db.execute(sql, params)
+            return cur.rowcount
+
+database = Database(DB, readers=DB_READERS, archive=ARCHIVE_DB)
+
+# ==================== БАЗА ДАННЫХ И МИГРАЦИИ ====================
+# Архив — отдельный файл с той же таблицей questions; схема создаётся при подключении,
+# а не миграцией, чтобы новый (или перенесённый) файл архива подхватывался сам
+QUESTION_COLUMNS = "id, from_user, to_user, text, answer, answered, hidden, special, likes, bumped_at, notified, created_at"
+ARCHIVE_SCHEMA = '''
+            CREATE TABLE IF NOT EXISTS archive.questions (
+                id INTEGER PRIMARY KEY,
+                from_user INT,
+                to_user INT,
+                text TEXT,
+                answer TEXT,
+                answered INT,
+                hidden INT,
+                special INT,
+                likes INT,
+                bumped_at TEXT,
+                notified INT,
+                created_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_questions_to ON questions(to_user);
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_questions_inbox
+                ON questions(to_user, COALESCE(bumped_at, created_at) DESC, id DESC, answered, hidden);
+'''
+# История целиком (экспорт, пересборка счётчиков) читается через этот view
+SQL_QUESTIONS_ALL_VIEW = f"""
+    CREATE TEMP VIEW IF NOT EXISTS questions_all AS
+    SELECT {QUESTION_COLUMNS} FROM main.questions
+    UNION ALL
+    SELECT {QUESTION_COLUMNS} FROM archive.questions
+"""
+
+# Пересборка user_stats/received_daily из questions (миграция 4 и rebuild-stats)
+SQL_REBUILD_STATS = '''
+            DELETE FROM user_stats;
+            INSERT INTO user_stats (user_id, sent, received, answered)
+                SELECT user_id, SUM(sent), SUM(received), SUM(answered) FROM (
+                    SELECT from_user AS user_id, COUNT(*) AS sent, 0 AS received, 0 AS answered
+                    FROM questions_all GROUP BY from_user
+                    UNION ALL
+                    SELECT to_user, 0, COUNT(*), SUM(answered = 1)
+                    FROM questions_all GROUP BY to_user
+                ) GROUP BY user_id;
+
+            DELETE FROM received_daily;
+            INSERT INTO received_daily (user_id, day, cnt)
+                SELECT to_user, date(created_at), COUNT(*) FROM questions_all
+                WHERE created_at >= date('now', '-6 days')
+                GROUP BY to_user, date(created_at);
+'''
+
+# Пересборка агрегатов админки (миграция 8 и rebuild-stats)
+SQL_REBUILD_TOTALS = '''
+            DELETE FROM counters;
+            INSERT INTO counters (name, value)
+                SELECT 'users', COUNT(*) FROM users
+                UNION ALL SELECT 'questions', COUNT(*) FROM questions_all;
+
+            DELETE FROM revenue;
+            INSERT INTO revenue (kind, key, payments, stars)
+                SELECT 'total', '', COUNT(*), COALESCE(SUM(amount), 0) FROM payments;
+            INSERT INTO revenue (kind, key, payments, stars)
+                SELECT 'payload', COALESCE(payload, ''), COUNT(*), SUM(amount) FROM payments
+                GROUP BY COALESCE(payload, '');
+            INSERT INTO revenue (kind, key, payments, stars)
+                SELECT 'day', date(created_at), COUNT(*), SUM(amount) FROM payments
+                GROUP BY date(created_at);
+'''
+
+# Премиум и триал хранятся в unix-секундах; «навсегда» — 9999-12-31 23:59:59 UTC
+LIFETIME_UNTIL = 253402300799
+DAY = 86400
+
+# Шаги применяются по порядку и ровно один раз; номер версии пишется в schema_version.
+# Шаг — либо SQL-скрипт, либо async-функция step(db) для миграций с логикой.
+MIGRATIONS = [
+    (1, "Базовая схема", '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -103,9 +711,656 @@ async def init_db():
                 payload TEXT,
                 created_at TEXT DEFAULT (datetime('now'))
             );
-        ''')
-        await db.commit()
-    print("✅ База данных инициализирована")
+    '''),
+    (2, "Индексы для горячих запросов", '''
+            CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
+            CREATE INDEX IF NOT EXISTS idx_questions_to_answered ON questions(to_user, answered);
+            CREATE INDEX IF NOT EXISTS idx_questions_from ON questions(from_user);
+            CREATE INDEX IF NOT EXISTS idx_questions_unnotified ON questions(from_user)
+                WHERE answered = 1 AND notified = 0;
+    '''),
+    (3, "Счётчики полученных вопросов для лидерборда", '''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                received INT NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_user_stats_received ON user_stats(received DESC);
+
+            CREATE TABLE IF NOT EXISTS received_daily (
+                user_id INT NOT NULL,
+                day TEXT NOT NULL,
+                cnt INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_received_daily_day ON received_daily(day);
+
+            INSERT OR REPLACE INTO user_stats (user_id, received)
+                SELECT to_user, COUNT(*) FROM questions GROUP BY to_user;
+            INSERT OR REPLACE INTO received_daily (user_id, day, cnt)
+                SELECT to_user, date(created_at), COUNT(*) FROM questions
+                WHERE created_at >= date('now', '-6 days')
+                GROUP BY to_user, date(created_at);
+    '''),
+    (4, "Денормализованные счётчики кабинета", '''
+            ALTER TABLE user_stats ADD COLUMN sent INT NOT NULL DEFAULT 0;
+            ALTER TABLE user_stats ADD COLUMN answered INT NOT NULL DEFAULT 0;
+    ''' + SQL_REBUILD_STATS),
+    (5, "Outbox уведомлений об ответах", '''
+            CREATE TABLE IF NOT EXISTS notify_outbox (
+                question_id INTEGER PRIMARY KEY,
+                chat_id INT NOT NULL,
+                created_at TEXT DEFAULT (datetime('now'))
+            );
+            INSERT OR IGNORE INTO notify_outbox (question_id, chat_id)
+                SELECT q.id, q.from_user FROM questions q
+                JOIN users u ON u.user_id = q.from_user AND u.push_answers = 1
+                WHERE q.answered = 1 AND q.notified = 0;
+            UPDATE questions SET notified = 1
+                WHERE answered = 1 AND notified = 0
+                AND id NOT IN (SELECT question_id FROM notify_outbox);
+    '''),
+    (6, "Связь отправленных сообщений с вопросами", '''
+            CREATE TABLE IF NOT EXISTS deliveries (
+                chat_id INT NOT NULL,
+                message_id INT NOT NULL,
+                question_id INT NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID;
+    '''),
+    # Старые текстовые колонки больше не пишутся: даты покупки и триала были в МСК,
+    # datetime() из рефералки — в UTC с секундами, '9999-12-31' — пожизненный
+    (7, "Премиум и триал в unix-секундах", '''
+            ALTER TABLE users ADD COLUMN premium_until_ts INT;
+            ALTER TABLE users ADD COLUMN trial_until_ts INT;
+            UPDATE users SET
+                premium_until_ts = CASE
+                    WHEN premium_until IS NULL OR premium_until = '' THEN NULL
+                    WHEN premium_until >= '9999' THEN ''' + str(LIFETIME_UNTIL) + '''
+                    WHEN length(premium_until) = 10 THEN CAST(strftime('%s', premium_until, '-3 hours') AS INT)
+                    ELSE CAST(strftime('%s', premium_until) AS INT)
+                END,
+                trial_until_ts = CAST(strftime('%s', trial_end, '-3 hours') AS INT)
+            WHERE premium_until IS NOT NULL OR trial_end IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS idx_users_premium_until ON users(premium_until_ts);
+            CREATE INDEX IF NOT EXISTS idx_users_trial_until ON users(trial_until_ts);
+    '''),
+    # Старые платежи остаются с charge_id = NULL — уникальный индекс их не трогает
+    (8, "Идемпотентные платежи и агрегаты админки", '''
+            ALTER TABLE payments ADD COLUMN charge_id TEXT;
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_charge ON payments(charge_id);
+
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INT NOT NULL DEFAULT 0
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS revenue (
+                kind TEXT NOT NULL,  -- 'total', 'payload' или 'day'
+                key TEXT NOT NULL,
+                payments INT NOT NULL DEFAULT 0,
+                stars INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, key)
+            ) WITHOUT ROWID;
+
+            -- Число строк ведут триггеры: учитывается любая вставка, откуда бы она ни пришла
+            CREATE TRIGGER IF NOT EXISTS trg_users_counter AFTER INSERT ON users BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'users';
+            END;
+            CREATE TRIGGER IF NOT EXISTS trg_questions_counter_add AFTER INSERT ON questions BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'questions';
+            END;
+            CREATE TRIGGER IF NOT EXISTS trg_questions_counter_del AFTER DELETE ON questions BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'questions';
+            END;
+    ''' + SQL_REBUILD_TOTALS),
+    (9, "Приглашения с отложенным начислением бонусов", '''
+            CREATE TABLE IF NOT EXISTS referrals (
+                invited_id INTEGER PRIMARY KEY,  -- один бонус на приглашённого
+                referrer_id INT NOT NULL,
+                created_at INT NOT NULL,
+                credited INT NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id, created_at);
+            CREATE INDEX IF NOT EXISTS idx_referrals_pending ON referrals(referrer_id) WHERE credited = 0;
+    '''),
+    # Архиватор удаляет строки из горячей таблицы, но вопросы при этом не исчезают
+    (10, "Счётчик вопросов не уменьшается при переносе в архив", '''
+            DROP TRIGGER IF EXISTS trg_questions_counter_del;
+    '''),
+    # Порядок входящих в Mini App; answered/hidden в хвосте — фильтры проверяются по индексу
+    (11, "Индекс входящих с учётом поднятых вопросов", '''
+            CREATE INDEX IF NOT EXISTS idx_questions_inbox
+                ON questions(to_user, COALESCE(bumped_at, created_at) DESC, id DESC, answered, hidden);
+    '''),
+    (12, "Служебные значения между запусками", '''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            ) WITHOUT ROWID;
+    '''),
+    # Архиватор удаляет доставки вместе с вопросами
+    (13, "Индекс доставок по вопросу", '''
+            CREATE INDEX IF NOT EXISTS idx_deliveries_question ON deliveries(question_id);
+    '''),
+    # Экспорт склеивает main и архив слиянием по id, без сортировки в TEMP B-TREE.
+    # В архиве idx_archive_questions_to и так упорядочен по rowid внутри to_user
+    (14, "Индекс вопросов получателя по id", '''
+            CREATE INDEX IF NOT EXISTS idx_questions_to_id ON questions(to_user, id);
+    '''),
+]
+
+async def schema_version(db) -> int:
+    row = await (await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")).fetchone()
+    return row[0]
+
+async def migrate(db):
+    """Применяет недостающие миграции, каждую в своей транзакции"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    await db.commit()
+
+    for version, name, step in MIGRATIONS:
+        if version <= await schema_version(db):
+            continue
+        # IMMEDIATE — чтобы два процесса не применили один шаг дважды
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= await schema_version(db):
+                await db.rollback()
+                continue
+            if callable(step):
+                await step(db)
+            else:
+                for statement in split_sql(step):
+                    await db.execute(statement)
+            await db.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        print(f"✅ Миграция {version}: {name}")
+
+def split_sql(script: str):
+    """Делит скрипт на выражения, не ломаясь на ';' внутри строк"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip():
+                yield statement.strip()
+            statement = ""
+    if statement.strip():
+        yield statement.strip()
+
+async def init_db():
+    async with database.write() as db:
+        await migrate(db)
+        version = await schema_version(db)
+        # Файл создан до auto_vacuum=INCREMENTAL — разово пересобираем, иначе
+        # освобождённые архиватором страницы не вернуть без полного VACUUM
+        mode, = await (await db.execute("PRAGMA main.auto_vacuum")).fetchone()
+        if mode != 2:
+            print("⏳ Перевод базы на auto_vacuum=INCREMENTAL (разовый VACUUM)...")
+            await db.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM main")
+    print(f"✅ База данных инициализирована (схема v{version})")
+
+# ==================== ПЛАНЫ ГОРЯЧИХ ЗАПРОСОВ ====================
+SQL_FIND_USER = "SELECT user_id FROM users WHERE LOWER(username) = ?"
+SQL_CHECK_USERNAME = "SELECT 1 FROM users WHERE user_id = ? AND lower(username) = ?"
+SQL_ADD_DELIVERY = "INSERT OR REPLACE INTO deliveries (chat_id, message_id, question_id) VALUES (?, ?, ?)"
+SQL_FIND_DELIVERY = """
+    SELECT q.id, q.from_user, q.to_user, q.hidden, q.answered
+    FROM deliveries d JOIN questions q ON q.id = d.question_id
+    WHERE d.chat_id = ? AND d.message_id = ?
+"""
+# Для сообщений, отправленных до появления deliveries
+SQL_FIND_LEGACY_QUESTION = """
+    SELECT id, from_user, to_user, hidden, answered FROM questions
+    WHERE to_user = ? AND text = ? AND answered = 0
+    ORDER BY id LIMIT 1
+"""
+SQL_ANSWER_QUESTION = """
+    UPDATE questions SET answer = ?, answered = 1
+    WHERE id = ? AND answered = 0
+    RETURNING id, from_user
+"""
+SQL_LIKE_QUESTION = "UPDATE questions SET likes = likes + ? WHERE id = ?"
+SQL_BUMP_QUESTION = "UPDATE questions SET bumped_at = datetime('now') WHERE id = ? AND to_user = ? RETURNING id"
+SQL_USER_STATS = """
+    SELECT COALESCE(s.sent, 0), COALESCE(s.received, 0), COALESCE(s.answered, 0),
+           u.badge, u.theme, u.accent_color
+    FROM users u LEFT JOIN user_stats s ON s.user_id = u.user_id
+    WHERE u.user_id = ?
+"""
+SQL_OUTBOX_ADD = "INSERT OR IGNORE INTO notify_outbox (question_id, chat_id) VALUES (?, ?)"
+SQL_OUTBOX_ALL = "SELECT question_id, chat_id FROM notify_outbox ORDER BY question_id"
+SQL_COUNT_RECEIVED = """
+    INSERT INTO user_stats (user_id, received) VALUES (?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET received = received + 1
+    RETURNING received
+"""
+SQL_COUNT_RECEIVED_DAILY = """
+    INSERT INTO received_daily (user_id, day, cnt) VALUES (?, date('now'), 1)
+    ON CONFLICT(user_id, day) DO UPDATE SET cnt = cnt + 1
+    RETURNING day, cnt
+"""
+SQL_COUNT_SENT = """
+    INSERT INTO user_stats (user_id, sent) VALUES (?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET sent = sent + 1
+"""
+SQL_COUNT_ANSWERED = "UPDATE user_stats SET answered = answered + ? WHERE user_id = ?"
+SQL_POPULAR_USERNAMES = """
+    SELECT u.user_id, lower(u.username) FROM user_stats s
+    JOIN users u ON u.user_id = s.user_id
+    ORDER BY s.received DESC LIMIT ?
+"""
+SQL_EXPORT_QUESTIONS = """
+    SELECT id, text, answer, created_at FROM questions_all
+    WHERE to_user = ? ORDER BY id
+"""
+# Регистрация и триал одним выражением. Строка возвращается, только если что-то
+# изменилось; fresh = 1 — триал выдан сейчас, то есть пользователь новый
+SQL_REGISTER_USER = """
+    INSERT INTO users (user_id, username, trial_until_ts) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        trial_until_ts = COALESCE(users.trial_until_ts, excluded.trial_until_ts)
+    WHERE users.username IS NOT excluded.username OR users.trial_until_ts IS NULL
+    RETURNING trial_until_ts = ?
+"""
+SQL_REFERRAL_ADD = """
+    INSERT INTO referrals (invited_id, referrer_id, created_at)
+    SELECT ?, user_id, ? FROM users WHERE user_id = ?
+    ON CONFLICT(invited_id) DO NOTHING
+"""
+SQL_REFERRAL_CLAIM = "UPDATE referrals SET credited = 1 WHERE credited = 0 RETURNING referrer_id"
+SQL_REFERRAL_CREDIT = """
+    UPDATE users SET referred_count = referred_count + ?,
+    premium_until_ts = MIN(MAX(COALESCE(premium_until_ts, 0), ?) + ?, ?)
+    WHERE user_id = ?
+"""
+SQL_REFERRALS_SINCE = "SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND created_at >= ?"
+SQL_ENTITLEMENTS = "SELECT premium_until_ts, trial_until_ts FROM users WHERE user_id = ?"
+SQL_ACTIVE_ENTITLEMENTS = """
+    SELECT user_id, premium_until_ts, trial_until_ts FROM users
+    WHERE premium_until_ts > ? OR trial_until_ts > ?
+"""
+SQL_COUNT_PREMIUM = "SELECT COUNT(*) FROM users WHERE premium_until_ts > ?"
+SQL_PAYMENT_ADD = """
+    INSERT INTO payments (charge_id, user_id, amount, payload) VALUES (?, ?, ?, ?)
+    ON CONFLICT(charge_id) DO NOTHING
+    RETURNING id
+"""
+SQL_REVENUE_ADD = """
+    INSERT INTO revenue (kind, key, payments, stars) VALUES (?, ?, 1, ?)
+    ON CONFLICT(kind, key) DO UPDATE SET payments = payments + 1, stars = stars + excluded.stars
+"""
+SQL_COUNTERS = "SELECT name, value FROM counters WHERE name IN ('users', 'questions')"
+SQL_REVENUE_REPORT = """
+    SELECT kind, key, payments, stars FROM revenue WHERE kind IN ('total', 'payload')
+    UNION ALL
+    SELECT kind, key, payments, stars FROM revenue WHERE kind = 'day' AND key >= ?
+"""
+# Входящие по курсору (sort_key, id). Строчное сравнение по выражению индекс не
+# сужает — отдельное «sort_key <= ?» даёт поиск в индексе, кортеж добивает равные
+SQL_INBOX = """
+    SELECT id, text, answer, answered, hidden, likes, bumped_at IS NOT NULL, COALESCE(bumped_at, created_at)
+    FROM {table} WHERE to_user = ? {where}
+    AND COALESCE(bumped_at, created_at) <= ? AND (COALESCE(bumped_at, created_at), id) < (?, ?)
+    ORDER BY COALESCE(bumped_at, created_at) DESC, id DESC LIMIT ?
+"""
+INBOX_FILTERS = {"all": "", "answered": "AND answered = 1", "pending": "AND answered = 0", "hidden": "AND hidden = 1"}
+SQL_INBOX_PAGE = {name: SQL_INBOX.format(table="main.questions", where=where) for name, where in INBOX_FILTERS.items()}
+# В архиве только отвеченные — «ждут ответа» туда не ходят
+SQL_INBOX_ARCHIVE = {name: SQL_INBOX.format(table="archive.questions", where=where)
+                     for name, where in INBOX_FILTERS.items() if name != "pending"}
+SQL_TOP_RECEIVED = "SELECT user_id, received FROM user_stats ORDER BY received DESC LIMIT ?"
+SQL_RECENT_DAILY = "SELECT user_id, day, cnt FROM received_daily WHERE day >= date('now', '-6 days')"
+
+# Метка -> (запрос, пример параметров). Каждый запрос обязан идти через индекс.
+HOT_QUERIES = {
+    "ask_username": (SQL_FIND_USER, ("user",)),
+    "ask_username.check": (SQL_CHECK_USERNAME, (1, "user")),
+    "handle_reply.find": (SQL_FIND_DELIVERY, (1, 1)),
+    "handle_reply.legacy": (SQL_FIND_LEGACY_QUESTION, (1, "text")),
+    "handle_reply.answer": (SQL_ANSWER_QUESTION, ("answer", 1)),
+    "handle_reply.like": (SQL_LIKE_QUESTION, (1, 1)),
+    "miniapp.stats": (SQL_USER_STATS, (1,)),
+    "ask_question.sent": (SQL_COUNT_SENT, (1,)),
+    "handle_reply.answered": (SQL_COUNT_ANSWERED, (1, 1)),
+    "leaderboard.top": (SQL_TOP_RECEIVED, (10,)),
+    "usernames.warm": (SQL_POPULAR_USERNAMES, (5000,)),
+    "export.questions": (SQL_EXPORT_QUESTIONS, (1,)),
+    "leaderboard.recent": (SQL_RECENT_DAILY, ()),
+    "entitlements.get": (SQL_ENTITLEMENTS, (1,)),
+    "entitlements.warm": (SQL_ACTIVE_ENTITLEMENTS, (0, 0)),
+    "admin.premium": (SQL_COUNT_PREMIUM, (0,)),
+    "admin.counters": (SQL_COUNTERS, ()),
+    "admin.revenue": (SQL_REVENUE_REPORT, ("2025-01-01",)),
+    "payment.add": (SQL_PAYMENT_ADD, ("charge", 1, 1, "month")),
+    "payment.revenue": (SQL_REVENUE_ADD, ("day", "2025-01-01", 1)),
+    "start.register": (SQL_REGISTER_USER, (1, "user", 0, 0)),
+    "start.referral": (SQL_REFERRAL_ADD, (1, 0, 2)),
+    "referrals.claim": (SQL_REFERRAL_CLAIM, ()),
+    "referrals.credit": (SQL_REFERRAL_CREDIT, (1, 0, 1, 1, 1)),
+    "referrals.today": (SQL_REFERRALS_SINCE, (1, 0)),
+    "payment.bump": (SQL_BUMP_QUESTION, (1, 1)),
+}
+for _name, _sql in SQL_INBOX_PAGE.items():
+    HOT_QUERIES[f"inbox.{_name}"] = (_sql, (1, "9999", "9999", 1, 21))
+for _name, _sql in SQL_INBOX_ARCHIVE.items():
+    HOT_QUERIES[f"inbox.archive.{_name}"] = (_sql, (1, "9999", "9999", 1, 21))
+
+async def check_query_plans(db) -> list:
+    """EXPLAIN QUERY PLAN для горячих запросов; возвращает полные сканы и сортировки во временном B-дереве"""
+    problems = []
+    # EXPLAIN не сверяет schema cookie — обычное чтение заставит соединение
+    # перечитать схему, если миграции только что добавили индексы
+    await (await db.execute("SELECT COUNT(*) FROM sqlite_master")).fetchone()
+    for label, (sql, params) in HOT_QUERIES.items():
+        rows = await (await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)).fetchall()
+        for row in rows:
+            detail = row[-1]
+            if (detail.startswith("SCAN") and "INDEX" not in detail) or "TEMP B-TREE" in detail:
+                problems.append(f"{label}: {detail}")
+    return problems
+
+# ==================== ЛИДЕРБОРД ====================
+class TopK:
+    """Топ-K по неубывающим счётчикам: обновление O(K), чтение O(1)"""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.items = []  # [(cnt, user_id)] по убыванию cnt
+
+    def offer(self, user_id: int, cnt: int):
+        for i, (_, uid) in enumerate(self.items):
+            if uid == user_id:
+                del self.items[i]
+                break
+        else:
+            if len(self.items) >= self.k and cnt <= self.items[-1][0]:
+                return
+        bisect.insort(self.items, (cnt, user_id), key=lambda item: -item[0])
+        del self.items[self.k:]
+
+class Leaderboard:
+    """Топ получателей за день, неделю и всё время без GROUP BY по questions"""
+
+    WINDOW_DAYS = 7
+
+    def __init__(self, k: int = 10):
+        self.k = k
+        self.all_time = TopK(k)
+        self.day = TopK(k)
+        self.week = TopK(k)
+        self.daily = {}  # день -> {user_id: cnt} за последние WINDOW_DAYS дней
+        self.names = {}  # user_id -> username для тех, кто в каком-либо топе
+        self.today = None
+
+    async def load(self):
+        """Начальная загрузка (и пересборка) из user_stats/received_daily"""
+        self.all_time = TopK(self.k)
+        for user_id, received in await database.fetchall(SQL_TOP_RECEIVED, (self.k,)):
+            self.all_time.offer(user_id, received)
+
+        self.daily = {}
+        for user_id, day, cnt in await database.fetchall(SQL_RECENT_DAILY):
+            self.daily.setdefault(day, {})[user_id] = cnt
+        self.today = None
+        self._roll(datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+        # Перечитываем и известные имена: /start в воркере меняет username
+        # мимо rename() главного процесса, который отдаёт /api/me
+        await self._fetch_names(refresh=True)
+
+    def _roll(self, today: str):
+        """Смена суток: отбрасываем старые дни и пересобираем оконные топы"""
+        if today == self.today:
+            return
+        self.today = today
+        oldest = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=self.WINDOW_DAYS - 1)).strftime("%Y-%m-%d")
+        self.daily = {day: counts for day, counts in self.daily.items() if day >= oldest}
+
+        self.day = TopK(self.k)
+        for user_id, cnt in self.daily.get(today, {}).items():
+            self.day.offer(user_id, cnt)
+
+        self.week = TopK(self.k)
+        for user_id, cnt in self._week_totals().items():
+            self.week.offer(user_id, cnt)
+
+    def _week_totals(self) -> dict:
+        totals = {}
+        for counts in self.daily.values():
+            for user_id, cnt in counts.items():
+                totals[user_id] = totals.get(user_id, 0) + cnt
+        return totals
+
+    async def record(self, user_id: int, received: int, day: str, day_cnt: int):
+        """Новый вопрос пользователю; счётчики — из RETURNING той же транзакции"""
+        self._roll(day)
+        today = self.daily.setdefault(day, {})
+        today[user_id] = day_cnt
+
+        self.all_time.offer(user_id, received)
+        self.day.offer(user_id, today[user_id])
+        self.week.offer(user_id, sum(counts.get(user_id, 0) for counts in self.daily.values()))
+        if user_id not in self.names:
+            await self._fetch_names()
+
+    async def refresher(self, interval: float = 60):
+        """Воркеры пишут счётчики в своих процессах — главный перечитывает топы"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception as e:
+                print(f"❌ Ошибка обновления лидерборда: {e}")
+
+    def rename(self, user_id: int, username: str):
+        if user_id in self.names:
+            self.names[user_id] = username
+
+    async def _fetch_names(self, refresh: bool = False):
+        ids = {uid for top in (self.all_time, self.day, self.week) for _, uid in top.items}
+        missing = list(ids) if refresh else [uid for uid in ids if uid not in self.names]
+        if missing:
+            marks = ",".join("?" * len(missing))
+            rows = await database.fetchall(f"SELECT user_id, username FROM users WHERE user_id IN ({marks})", missing)
+            self.names.update(rows)
+        # Держим имена только для тех, кто сейчас в топах
+        self.names = {uid: name for uid, name in self.names.items() if uid in ids}
+
+    def top(self, window: str = "all") -> list:
+        """[(username, cnt)] за окно day / week / all"""
+        self._roll(datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+        board = {"day": self.day, "week": self.week, "all": self.all_time}[window]
+        return [(self.names.get(uid), cnt) for cnt, uid in board.items]
+
+leaderboard = Leaderboard()
+
+# ==================== КЭШ USERNAME ====================
+class UsernameCache:
+    """username -> user_id: LRU с TTL; промахи кэшируются на короткий срок.
+
+    С verify=True (несколько воркеров) попадание перепроверяется по первичному
+    ключу: переименование, увиденное другим процессом, не должно отправить
+    анонимный вопрос не тому человеку.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: float = 600, negative_ttl: float = 30, verify: bool = False):
+        self.maxsize = maxsize
+        self.verify = verify
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # username -> (user_id или None, истекает)
+        self.names = {}  # user_id -> username, чтобы снять старое имя при переименовании
+        self.hits = self.misses = self.negative_hits = self.stale = 0
+
+    def _put(self, username: str, user_id, ttl: float):
+        self.entries[username] = (user_id, time.monotonic() + ttl)
+        self.entries.move_to_end(username)
+        if user_id is not None:
+            self.names[user_id] = username
+        while len(self.entries) > self.maxsize:
+            old_name, (old_id, _) = self.entries.popitem(last=False)
+            if old_id is not None and self.names.get(old_id) == old_name:
+                del self.names[old_id]
+
+    def _drop(self, username: str):
+        user_id, _ = self.entries.pop(username, (None, 0))
+        if user_id is not None and self.names.get(user_id) == username:
+            del self.names[user_id]
+
+    async def resolve(self, username: str):
+        """user_id по username (в нижнем регистре) или None"""
+        entry = self.entries.get(username)
+        if entry and entry[1] > time.monotonic():
+            if entry[0] is None:
+                self.entries.move_to_end(username)
+                self.negative_hits += 1
+                return None
+            if not self.verify or await database.fetchone(SQL_CHECK_USERNAME, (entry[0], username)):
+                self.entries.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+            self.stale += 1
+
+        self.misses += 1
+        row = await database.fetchone(SQL_FIND_USER, (username,))
+        user_id = row[0] if row else None
+        if entry:
+            self._drop(username)
+        self._put(username, user_id, self.ttl if user_id is not None else self.negative_ttl)
+        return user_id
+
+    def update(self, user_id: int, username: str):
+        """Регистрация или смена username в start_cmd"""
+        old = self.names.get(user_id)
+        if old is not None and old != username:
+            self._drop(old)
+        if username:
+            self._drop(username)
+            self._put(username, user_id, self.ttl)
+
+    async def warm(self, limit: int = 5000):
+        """Прогрев самыми популярными получателями"""
+        rows = await database.fetchall(SQL_POPULAR_USERNAMES, (limit,))
+        for user_id, username in reversed(rows):
+            if username:
+                self._put(username, user_id, self.ttl)
+        print(f"✅ Кэш username прогрет: {len(self.entries)}")
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits,
+                "negative_hits": self.negative_hits, "misses": self.misses, "stale": self.stale}
+
+usernames = UsernameCache(verify=WORKERS > 1)
+
+# ==================== ПРЕМИУМ И ТРИАЛ ====================
+class Entitlements:
+    """user_id -> (premium_until, trial_until) в unix-секундах: LRU в памяти.
+
+    Оплата и реферальный бонус сбрасывают запись. Истёкшие с момента загрузки
+    и устаревшие записи (их мог продлить другой процесс) свипер перечитывает пачками.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 120):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (premium_until, trial_until, загружено)
+        self.version = 0  # растёт при сбросе — чтобы чтение в полёте не вернуло старое
+        self.hits = self.misses = self.refreshed = 0
+
+    def _put(self, user_id: int, premium_until, trial_until, loaded: float):
+        self.entries[user_id] = (premium_until, trial_until, loaded)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def get(self, user_id: int) -> tuple:
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+        self.misses += 1
+        version, loaded = self.version, time.time()
+        row = await database.fetchone(SQL_ENTITLEMENTS, (user_id,))
+        premium_until, trial_until = row or (None, None)
+        if version == self.version:
+            self._put(user_id, premium_until, trial_until, loaded)
+        return premium_until, trial_until
+
+    async def status(self, user_id: int) -> Optional[str]:
+        """'premium', 'trial' или None прямо сейчас"""
+        premium_until, trial_until = await self.get(user_id)
+        now = time.time()
+        if premium_until and premium_until > now:
+            return "premium"
+        if trial_until and trial_until > now:
+            return "trial"
+        return None
+
+    def invalidate(self, user_id: int):
+        self.version += 1
+        self.entries.pop(user_id, None)
+
+    async def warm(self):
+        """Все действующие премиумы и триалы"""
+        now = int(time.time())
+        rows = await database.fetchall(SQL_ACTIVE_ENTITLEMENTS, (now, now))
+        for user_id, premium_until, trial_until in rows[-self.maxsize:]:
+            self._put(user_id, premium_until, trial_until, now)
+        print(f"✅ Кэш премиумов прогрет: {len(self.entries)}")
+
+    async def refresh(self, batch: int = 500) -> int:
+        now = time.time()
+        stale = [
+            user_id for user_id, (premium_until, trial_until, loaded) in self.entries.items()
+            if loaded + self.ttl < now
+            or any(until and loaded < until <= now for until in (premium_until, trial_until))
+        ]
+        for i in range(0, len(stale), batch):
+            ids = stale[i:i + batch]
+            version, loaded = self.version, time.time()
+            rows = await database.fetchall(
+                f"SELECT user_id, premium_until_ts, trial_until_ts FROM users "
+                f"WHERE user_id IN ({','.join('?' * len(ids))})", ids
+            )
+            if version != self.version:
+                continue  # между чтением и записью был сброс — дочитаем на следующем круге
+            fresh = {row[0]: row[1:] for row in rows}
+            for user_id in ids:
+                if user_id not in self.entries:
+                    continue
+                if user_id in fresh:
+                    self.entries[user_id] = (*fresh[user_id], loaded)
+                else:
+                    del self.entries[user_id]
+        self.refreshed += len(stale)
+        return len(stale)
+
+    async def sweeper(self, interval: float = 30):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"❌ Ошибка обновления кэша премиумов: {e}")
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "refreshed": self.refreshed}
+
+entitlements = Entitlements()
 
 # ==================== FSM СОСТОЯНИЯ ====================
 class Ask(StatesGroup):
@@ -116,16 +1371,16 @@ class Ask(StatesGroup):
 # ==================== КЛАВИАТУРЫ ====================
 def main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Личный кабинет", web_app=WebAppInfo(url=f"{BASE_URL}/miniapp"))],
-        [InlineKeyboardButton("Задать вопрос", callback_data="ask")]
+        [InlineKeyboardButton(text="Личный кабинет", web_app=WebAppInfo(url=f"{BASE_URL}/miniapp"))],
+        [InlineKeyboardButton(text="Задать вопрос", callback_data="ask")]
     ])
 
 def premium_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("135⭐ — 1 месяц", callback_data="buy_135")],
-        [InlineKeyboardButton("330⭐ — 3 месяца", callback_data="buy_330")],
-        [InlineKeyboardButton("1050⭐ — год", callback_data="buy_1050")],
-        [InlineKeyboardButton("2600⭐ — пожизненно", callback_data="buy_2600")]
+        [InlineKeyboardButton(text="135⭐ — 1 месяц", callback_data="buy_135")],
+        [InlineKeyboardButton(text="330⭐ — 3 месяца", callback_data="buy_330")],
+        [InlineKeyboardButton(text="1050⭐ — год", callback_data="buy_1050")],
+        [InlineKeyboardButton(text="2600⭐ — пожизненно", callback_data="buy_2600")]
     ])
 
 # ==================== СТАРТ + РЕФЕРАЛКА ====================
@@ -136,32 +1391,22 @@ async def start_cmd(m: types.Message):
     if len(args) > 1 and args[1].isdigit():
         ref_id = int(args[1])
 
-    async with aiosqlite.connect(DB) as db:
-        # Регистрация пользователя
-        await db.execute(
-            "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-            (m.from_user.id, m.from_user.username or "")
-        )
+    now = int(time.time())
+    trial_until = now + 3 * DAY
+    async with database.write() as db:
+        # Регистрация, актуальный username и триал 3 дня — одним выражением
+        row = await (await db.execute(
+            SQL_REGISTER_USER, (m.from_user.id, m.from_user.username or "", trial_until, trial_until)
+        )).fetchone()
+        # Приглашение записываем только для нового пользователя и один раз;
+        # бонус начислит и сообщит рефереру фоновая задача
+        if row and row[0] and ref_id and ref_id != m.from_user.id:
+            await db.execute(SQL_REFERRAL_ADD, (m.from_user.id, now, ref_id))
 
-        # Рефералка
-        if ref_id and ref_id != m.from_user.id:
-            await db.execute("""
-                UPDATE users SET referred_count = referred_count + 1,
-                premium_until = datetime(COALESCE(premium_until, 'now'), '+1 day')
-                WHERE user_id = ?
-            """, (ref_id,))
-            try:
-                await bot.send_message(ref_id, "Приглашён друг — +1 день безлимита!")
-            except:
-                pass
-
-        # Триал 3 дня
-        row = await (await db.execute("SELECT trial_end FROM users WHERE user_id=?", (m.from_user.id,))).fetchone()
-        if not row or not row[0]:
-            trial_end = (datetime.now(timezone(timedelta(hours=3))) + timedelta(days=3)).strftime("%Y-%m-%d %H:%M")
-            await db.execute("UPDATE users SET trial_end=? WHERE user_id=?", (trial_end, m.from_user.id))
-
-        await db.commit()
+    if row:
+        entitlements.invalidate(m.from_user.id)
+    usernames.update(m.from_user.id, (m.from_user.username or "").lower())
+    leaderboard.rename(m.from_user.id, m.from_user.username or "")
 
     await m.answer(
         "Анонимные вопросы 2025\n\n"
@@ -172,6 +1417,162 @@ async def start_cmd(m: types.Message):
         reply_markup=main_kb()
     )
 
+# ==================== РЕФЕРАЛЬНЫЕ БОНУСЫ ====================
+class ReferralCredits:
+    """Бонусы за приглашённых: пачкой раз в interval секунд и одним сообщением рефереру.
+
+    /start только пишет строку в referrals. Работает в главном процессе и забирает
+    приглашения, записанные любым воркером; незабранные переживают рестарт.
+    """
+
+    def __init__(self, interval: float = 30, attempts: int = 3):
+        self.interval = interval
+        self.attempts = attempts
+        self.task = None
+        self.credited = self.notified = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Ошибка начисления реферальных бонусов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def flush(self) -> int:
+        now = int(time.time())
+        async with database.write() as db:
+            # Забираем и помечаем одним UPDATE — параллельные вставки воркеров не потеряются
+            claimed = await (await db.execute(SQL_REFERRAL_CLAIM)).fetchall()
+            counts = {}
+            for referrer_id, in claimed:
+                counts[referrer_id] = counts.get(referrer_id, 0) + 1
+            await db.executemany(SQL_REFERRAL_CREDIT, [
+                (n, now, n * DAY, LIFETIME_UNTIL, referrer_id) for referrer_id, n in counts.items()
+            ])
+        if not counts:
+            return 0
+        self.credited += len(claimed)
+
+        today = int(datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+        for referrer_id, n in counts.items():
+            entitlements.invalidate(referrer_id)
+            total, = await database.fetchone(SQL_REFERRALS_SINCE, (referrer_id, today))
+            await self._notify(referrer_id, f"🎉 Приглашено друзей: +{n} (сегодня {total}) — +{n} дн. безлимита!")
+        return len(claimed)
+
+    async def _notify(self, chat_id: int, text: str):
+        for attempt in range(1, self.attempts + 1):
+            await notifier.bucket.acquire()  # общий лимит отправки с пушами
+            try:
+                await bot.send_message(chat_id, text)
+                self.notified += 1
+                return
+            except TelegramRetryAfter as e:
+                # Флуд-контроль: ждём и повторяем, но не бесконечно — бонус уже начислен
+                if attempt == self.attempts:
+                    print(f"⚠️ Сообщение о бонусе {chat_id} не отправлено: 429 {self.attempts} раза подряд")
+                    return
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                return  # реферер заблокировал бота — бонус уже начислен
+
+referrals = ReferralCredits()
+
+# ==================== ОТЛОЖЕННЫЕ СЧЁТЧИКИ ====================
+class CounterBuffer:
+    """Write-behind для горячих счётчиков: дельты по строке копятся в памяти.
+
+    Сброс — одной транзакцией с executemany раз в interval секунд или сразу,
+    как только набралось max_keys строк, и обязательно на остановке. Читатели
+    прибавляют pending() к значению из базы. Буфер у каждого процесса свой:
+    чужие несброшенные дельты видны через interval. При падении процесса
+    теряется не больше одного интервала — для лайков это допустимо.
+    """
+
+    def __init__(self, statements: dict, interval: float = 0.5, max_keys: int = 1000):
+        self.statements = statements  # счётчик -> UPDATE ... SET col = col + ? WHERE id = ?
+        self.interval = interval
+        self.max_keys = max_keys
+        self.deltas = {}  # (счётчик, id) -> дельта
+        self.flushing = {}  # сбрасываемая сейчас пачка — ещё не в базе
+        self.wake = asyncio.Event()
+        self.task = None
+        self.running = False
+        self.added = self.flushes = 0
+
+    def add(self, name: str, row_id: int, delta: int = 1):
+        key = (name, row_id)
+        self.deltas[key] = self.deltas.get(key, 0) + delta
+        self.added += 1
+        if len(self.deltas) >= self.max_keys:
+            self.wake.set()
+
+    def pending(self, name: str, row_id: int) -> int:
+        key = (name, row_id)
+        return self.deltas.get(key, 0) + self.flushing.get(key, 0)
+
+    async def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        # Без cancel: прерванный посреди commit сброс мог бы записать дельты дважды
+        if self.task:
+            self.running = False
+            self.wake.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+    async def _loop(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Ошибка сброса счётчиков: {e}")
+
+    async def flush(self):
+        if not self.deltas or self.flushing:
+            return
+        self.flushing, self.deltas = self.deltas, {}
+        batches = {}
+        for (name, row_id), delta in self.flushing.items():
+            batches.setdefault(name, []).append((delta, row_id))
+        try:
+            async with database.write() as db:
+                for name, rows in batches.items():
+                    await db.executemany(self.statements[name], rows)
+        except BaseException:
+            # Не записали — вернём дельты, следующий сброс попробует снова
+            for key, delta in self.flushing.items():
+                self.deltas[key] = self.deltas.get(key, 0) + delta
+            raise
+        finally:
+            self.flushing = {}
+        self.flushes += 1
+        metrics.inc("bot_counter_flushes_total")
+        metrics.inc("bot_counter_increments_total", (), sum(len(rows) for rows in batches.values()))
+
+    def stats(self) -> dict:
+        return {"pending": len(self.deltas), "added": self.added, "flushes": self.flushes}
+
+counter_buffer = CounterBuffer({"likes": SQL_LIKE_QUESTION})
+
 # ==================== ЗАДАТЬ ВОПРОС ====================
 @dp.callback_query(F.data == "ask")
 async def ask_start(c: types.CallbackQuery, state: FSMContext):
@@ -181,37 +1582,42 @@ async def ask_start(c: types.CallbackQuery, state: FSMContext):
 @dp.message(Ask.username)
 async def ask_username(m: types.Message, state: FSMContext):
     username = m.text.lstrip("@").lower()
-    async with aiosqlite.connect(DB) as db:
-        row = await (await db.execute("SELECT user_id FROM users WHERE LOWER(username) = ?", (username,))).fetchone()
-        if not row:
-            await m.answer("Такого пользователя ещё нет в боте — мы уведомим его при старте!", reply_markup=main_kb())
-            await state.clear()
-            return
+    to_id = await usernames.resolve(username)
+    if to_id is None:
+        await m.answer("Такого пользователя ещё нет в боте — мы уведомим его при старте!", reply_markup=main_kb())
+        await state.clear()
+        return
 
-        await state.update_data(to_id=row[0])
-        await m.answer("Напиши свой вопрос:")
-        await state.set_state(Ask.question)
+    await state.update_data(to_id=to_id)
+    await m.answer("Напиши свой вопрос:")
+    await state.set_state(Ask.question)
 
 @dp.message(Ask.question)
 async def ask_question(m: types.Message, state: FSMContext):
     data = await state.get_data()
     to_id = data["to_id"]
 
-    async with aiosqlite.connect(DB) as db:
-        await db.execute(
-            "INSERT INTO questions (from_user, to_user, text) VALUES (?, ?, ?)",
+    async with database.write() as db:
+        qid, = await (await db.execute(
+            "INSERT INTO questions (from_user, to_user, text) VALUES (?, ?, ?) RETURNING id",
             (m.from_user.id, to_id, m.text)
-        )
-        await db.commit()
+        )).fetchone()
+        # Счётчики кабинета и лидерборда — в той же транзакции, что и сам вопрос
+        await db.execute(SQL_COUNT_SENT, (m.from_user.id,))
+        received, = await (await db.execute(SQL_COUNT_RECEIVED, (to_id,))).fetchone()
+        day, day_cnt = await (await db.execute(SQL_COUNT_RECEIVED_DAILY, (to_id,))).fetchone()
+    await leaderboard.record(to_id, received, day, day_cnt)
 
-    await bot.send_message(
+    sent = await bot.send_message(
         to_id,
         f"Новый анонимный вопрос:\n\n{m.text}\n\nОтветь на это сообщение — ответ уйдёт анонимно",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton("Поднять в топ — 1⭐", callback_data="bump_question")],
-            [InlineKeyboardButton("Скрытый ответ — 3⭐", callback_data="hidden_answer")]
+            [InlineKeyboardButton(text="Поднять в топ — 1⭐", callback_data=f"bump_question:{qid}")],
+            [InlineKeyboardButton(text="Скрытый ответ — 3⭐", callback_data="hidden_answer")]
         ])
     )
+    # Ответ/лайк на это сообщение найдём по (chat_id, message_id)
+    await database.execute(SQL_ADD_DELIVERY, (to_id, sent.message_id, qid))
 
     await m.answer("Вопрос успешно отправлен!", reply_markup=main_kb())
     await state.clear()
@@ -220,36 +1626,38 @@ async def ask_question(m: types.Message, state: FSMContext):
 async def handle_reply(m: types.Message):
     orig = m.reply_to_message
 
-    # Ответ на вопрос
-    if "Новый анонимный вопрос" in orig.text:
-        qtext = orig.text.split("\n\n", 1)[1].split("\n\n", 1)[0]
-
-        async with aiosqlite.connect(DB) as db:
-            q = await (await db.execute(
-                "SELECT from_user, hidden FROM questions WHERE to_user = ? AND text = ? AND answered = 0",
-                (m.from_user.id, qtext)
-            )).fetchone()
-
-            if q:
-                from_user, is_hidden = q
-                await db.execute(
-                    "UPDATE questions SET answer = ?, answered = 1 WHERE to_user = ? AND text = ?",
-                    (m.text, m.from_user.id, qtext)
-                )
-                await db.commit()
-
-                await bot.send_message(
-                    from_user,
-                    f"Тебе {'скрыто ' if is_hidden else ''}ответили анонимно:\n\n{m.text}"
-                )
-                await m.answer("Ответ отправлен анонимно!", reply_markup=main_kb())
-
-    # Лайк вопроса
+    q = await database.fetchone(SQL_FIND_DELIVERY, (m.chat.id, orig.message_id))
+    if not q and orig.text and "Новый анонимный вопрос" in orig.text:
+        qtext = orig.text.split("\n\n", 1)[1].rsplit("\n\n", 1)[0]
+        q = await database.fetchone(SQL_FIND_LEGACY_QUESTION, (m.from_user.id, qtext))
+    if not q:
+        return
+    qid, from_user, to_user, is_hidden, answered = q
+
+    # Лайк вопроса — в буфер, в базу уйдёт пачкой
     if m.text in ["❤️", "♥️"]:
-        async with aiosqlite.connect(DB) as db:
-            await db.execute("UPDATE questions SET likes = likes + 1 WHERE id = ?", (orig.message_id,))
-            await db.commit()
+        counter_buffer.add("likes", qid)
         await m.answer("❤️")
+        return
+
+    # Ответ на вопрос
+    if to_user == m.from_user.id and not answered and m.text:
+        async with database.write() as db:
+            answered_rows = await (await db.execute(SQL_ANSWER_QUESTION, (m.text, qid))).fetchall()
+            await db.execute(SQL_COUNT_ANSWERED, (len(answered_rows), m.from_user.id))
+            # Пуш об ответе — через outbox в той же транзакции
+            staged = await notifier.stage(db, answered_rows)
+        notifier.submit(staged)
+        if not answered_rows:
+            return
+
+        sent = await bot.send_message(
+            from_user,
+            f"Тебе {'скрыто ' if is_hidden else ''}ответили анонимно:\n\n{m.text}"
+        )
+        # Чтобы спросивший мог лайкнуть ответ реплаем
+        await database.execute(SQL_ADD_DELIVERY, (from_user, sent.message_id, qid))
+        await m.answer("Ответ отправлен анонимно!", reply_markup=main_kb())
 
 # ==================== СИСТЕМА ОПЛАТЫ ====================
 @dp.pre_checkout_query()
@@ -257,14 +1665,21 @@ async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery)
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 # Поднять вопрос за 1 звезду
-@dp.callback_query(F.data == "bump_question")
+@dp.callback_query(F.data.startswith("bump_question"))
 async def bump_question(c: types.CallbackQuery):
+    qid = c.data.partition(":")[2]
+    if not qid.isdigit():
+        # Кнопки без id вопроса — ищем вопрос по самому сообщению
+        q = await database.fetchone(SQL_FIND_DELIVERY, (c.message.chat.id, c.message.message_id))
+        if not q:
+            return await c.answer("❌ Вопрос не найден", show_alert=True)
+        qid = q[0]
     await c.message.edit_reply_markup()
     await bot.send_invoice(
         chat_id=c.from_user.id,
         title="Поднять вопрос в топ",
         description="Вопрос снова придёт как новый",
-        payload="bump",
+        payload=f"bump:{qid}",
         provider_token="",  # Для звезд не нужен
         currency="XTR",  # Код для звезд
         prices=[LabeledPrice(label="1 Star", amount=100)]  # 1 звезда = 100 единиц
@@ -300,54 +1715,62 @@ async def export_pdf(c: types.CallbackQuery):
 # Обработка успешных платежей
 @dp.message(F.successful_payment)
 async def successful_payment(m: types.Message):
-    payload = m.successful_payment.invoice_payload
+    # payload — тип покупки, после двоеточия — её объект (bump:<id вопроса>)
+    payload, _, target = m.successful_payment.invoice_payload.partition(":")
     amount = m.successful_payment.total_amount // 100  # Конвертируем обратно в звезды
-    
-    print(f"✅ Получена оплата: {amount} звезд, payload: {payload}")
+    charge_id = m.successful_payment.telegram_payment_charge_id
+
+    async with database.write() as db:
+        # Сохраняем платеж; повтор того же апдейта от Telegram ничего не меняет
+        row = await (await db.execute(SQL_PAYMENT_ADD, (charge_id, m.from_user.id, amount, payload))).fetchone()
+        if row is None:
+            print(f"⚠️ Повтор платежа {charge_id} — пропускаем")
+            return
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        await db.executemany(SQL_REVENUE_ADD, [
+            ("total", "", amount), ("payload", payload, amount), ("day", day, amount)
+        ])
 
-    async with aiosqlite.connect(DB) as db:
-        # Сохраняем платеж
-        await db.execute(
-            "INSERT INTO payments (user_id, amount, payload) VALUES (?, ?, ?)",
-            (m.from_user.id, amount, payload)
-        )
-        
         # Обработка разных типов платежей
         if payload in ["month", "3month", "year", "life"]:
-            days = {"month": 30, "3month": 90, "year": 365, "life": 99999}[payload]
-            if days == 99999:
-                end_date = "9999-12-31"
+            days = {"month": 30, "3month": 90, "year": 365, "life": None}[payload]
+            if days is None:
+                premium_until = LIFETIME_UNTIL
                 badge = "LEGEND"
             else:
-                end_date = (datetime.now(timezone(timedelta(hours=3))) + timedelta(days=days)).strftime("%Y-%m-%d")
+                premium_until = int(time.time()) + days * DAY
                 badge = "VIP"
-            
+
             await db.execute(
-                "UPDATE users SET premium_until = ?, premium_type = ?, badge = ? WHERE user_id = ?",
-                (end_date, payload, badge, m.from_user.id)
+                "UPDATE users SET premium_until_ts = ?, premium_type = ?, badge = ? WHERE user_id = ?",
+                (premium_until, payload, badge, m.from_user.id)
             )
-            await m.answer(f"✅ Премиум активирован! Спасибо за покупку {amount}⭐", reply_markup=main_kb())
-        
-        elif payload == "bump":
+
+        bumped = False
+        if payload == "bump" and target.isdigit():
+            # Новый ключ сортировки — вопрос переезжает наверх входящих
+            bumped = await (await db.execute(SQL_BUMP_QUESTION, (int(target), m.from_user.id))).fetchone() is not None
+    entitlements.invalidate(m.from_user.id)
+
+    print(f"✅ Получена оплата: {amount} звезд, payload: {payload}")
+
+    # Ответы пользователю — после коммита, без удержания писателя
+    if payload in ["month", "3month", "year", "life"]:
+        await m.answer(f"✅ Премиум активирован! Спасибо за покупку {amount}⭐", reply_markup=main_kb())
+
+    elif payload == "bump":
+        if bumped:
             await m.answer("✅ Вопрос поднят в топ!", reply_markup=main_kb())
-        
-        elif payload == "hidden":
-            await m.answer("✅ Режим скрытого ответа активирован!", reply_markup=main_kb())
-        
-        elif payload == "pdf":
-            # Генерация PDF
-            buffer = BytesIO()
-            c = canvas.Canvas(buffer, pagesize=A4)
-            c.drawString(100, 750, "Ваши вопросы и ответы")
-            c.save()
-            buffer.seek(0)
-            
-            await m.answer_document(
-                InputFile(buffer, filename="questions.pdf"),
-                caption="✅ Ваш PDF с вопросами и ответами!"
-            )
-        
-        await db.commit()
+        else:
+            await m.answer("⚠️ Вопрос не найден — напишите в поддержку, вернём звезду", reply_markup=main_kb())
+
+    elif payload == "hidden":
+        await m.answer("✅ Режим скрытого ответа активирован!", reply_markup=main_kb())
+
+    elif payload == "pdf":
+        # Рендер в пуле процессов, PDF придёт отдельным сообщением
+        await m.answer("⏳ Готовим PDF с вопросами и ответами — пришлём, как только он будет готов")
+        await exporter.submit(m.from_user.id, m.chat.id)
 
 # Обработка кнопок покупки премиума
 @dp.callback_query(F.data.startswith("buy_"))
@@ -371,143 +1794,458 @@ async def buy_premium(c: types.CallbackQuery):
             prices=[LabeledPrice(label=plan["label"], amount=plan["amount"])]
         )
         # ==================== ПОЛНЫЙ MINI APP ====================
-async def miniapp_handler(request):
+# Статичная оболочка: одинакова для всех, данные приходят из /api/me
+MINIAPP_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width,initial-scale=1">
+    <script src="https://telegram.org/js/telegram-web-app.js"></script>
+    <style>
+        :root {--accent:#8774e1}
+        body {font-family:system-ui; padding:20px; background:var(--tg-theme-bg-color); color:var(--tg-theme-text-color); text-align:center}
+        .card {background:var(--tg-theme-secondary-bg-color); border-radius:16px; padding:24px; margin:15px 0}
+        .num {font-size:52px; font-weight:800; color:var(--accent)}
+        button {margin:12px 0; padding:18px; width:90%; background:var(--accent); color:white; border:none; border-radius:16px; font-size:20px; cursor:pointer}
+        .top {font-size:15px; margin-top:30px; line-height:1.8}
+        .tabs button {width:30%; margin:4px; padding:10px; font-size:15px}
+        .badge {font-size:28px; margin:15px}
+        .tabs.four button {width:22%; font-size:13px}
+        .q {text-align:left; padding:16px; margin:10px 0; white-space:pre-wrap; word-wrap:break-word}
+        .q .answer {margin-top:8px; opacity:.75}
+    </style>
+</head>
+<body>
+    <h1>Личный кабинет <div class="badge" id="badge"></div></h1>
+
+    <div class="card"><div class="num" id="sent">…</div>Отправлено вопросов</div>
+    <div class="card"><div class="num" id="received">…</div>Получено вопросов</div>
+    <div class="card"><div class="num" id="answered">…</div>Отвечено</div>
+    <div class="card"><div class="num" id="pending" style="color:#e74c3c">…</div>Ждут ответа</div>
+    <div class="card"><b>Премиум до:</b> <span id="premium">…</span></div>
+
+    <button onclick="buyPremium('month', 13500)">135⭐ — 1 месяц</button>
+    <button onclick="buyPremium('3month', 33000)">330⭐ — 3 месяца</button>
+    <button onclick="buyPremium('year', 105000)">1050⭐ — год</button>
+    <button onclick="buyPremium('life', 260000)">2600⭐ — навсегда</button>
+
+    <h3>Топ-10 пользователей</h3>
+    <div class="tabs">
+        <button onclick="showTop('day')">День</button>
+        <button onclick="showTop('week')">Неделя</button>
+        <button onclick="showTop('all')">Всё время</button>
+    </div>
+    <div class="top" id="top-day" style="display:none"></div>
+    <div class="top" id="top-week" style="display:none"></div>
+    <div class="top" id="top-all"></div>
+
+    <h3>Мои вопросы</h3>
+    <div class="tabs four">
+        <button onclick="loadInbox('all')">Все</button>
+        <button onclick="loadInbox('pending')">Ждут</button>
+        <button onclick="loadInbox('answered')">Отвечены</button>
+        <button onclick="loadInbox('hidden')">Скрытые</button>
+    </div>
+    <div id="inbox"></div>
+    <button id="more" style="display:none" onclick="loadInbox()">Показать ещё</button>
+
+    <script>
+        function showTop(window_) {
+            ['day', 'week', 'all'].forEach(function(w) {
+                document.getElementById('top-' + w).style.display = w === window_ ? 'block' : 'none';
+            });
+        }
+
+        function renderTop(window_, rows) {
+            var box = document.getElementById('top-' + window_);
+            box.textContent = rows.length ? '' : 'Пока пусто';
+            rows.forEach(function(row, i) {
+                box.appendChild(document.createTextNode((i + 1) + '. @' + (row[0] || 'аноним') + ' — ' + row[1] + ' вопросов'));
+                box.appendChild(document.createElement('br'));
+            });
+        }
+
+        function render(me) {
+            ['sent', 'received', 'answered', 'pending'].forEach(function(k) {
+                document.getElementById(k).textContent = me.stats[k];
+            });
+            document.getElementById('premium').textContent = me.lifetime ? 'Навсегда'
+                : me.premium_until ? new Date(me.premium_until * 1000).toLocaleDateString('ru-RU')
+                : me.trial ? 'Пробный период' : 'Нет';
+            document.getElementById('badge').textContent = me.badge ? '🏆 ' + me.badge : '';
+            if (me.accent) document.documentElement.style.setProperty('--accent', me.accent);
+            ['day', 'week', 'all'].forEach(function(w) { renderTop(w, me.leaderboard[w]); });
+        }
+
+        // Входящие страницами: курсор из прошлого ответа, без OFFSET
+        var inbox = {filter: 'all', cursor: null};
+
+        function loadInbox(filter) {
+            var box = document.getElementById('inbox');
+            if (filter) {
+                inbox = {filter: filter, cursor: null};
+                box.textContent = '';
+            }
+            var current = inbox;
+            var url = '/api/inbox?filter=' + inbox.filter + (inbox.cursor ? '&cursor=' + inbox.cursor : '');
+            fetch(url, {headers: {'X-Telegram-Init-Data': Telegram.WebApp.initData}})
+                .then(function(r) { if (!r.ok) throw new Error(r.status); return r.json(); })
+                .then(function(page) {
+                    if (current !== inbox) return;  // пока грузили, переключили фильтр
+                    page.items.forEach(function(q) {
+                        var card = document.createElement('div');
+                        card.className = 'card q';
+                        card.textContent = (q.bumped ? '🔝 ' : '') + (q.hidden ? '🔒 ' : '') + q.text;
+                        var answer = document.createElement('div');
+                        answer.className = 'answer';
+                        answer.textContent = q.answered ? '↳ ' + (q.answer || '') : '⏳ Ждёт ответа';
+                        card.appendChild(answer);
+                        box.appendChild(card);
+                    });
+                    if (!box.childNodes.length) box.textContent = 'Пока пусто';
+                    inbox.cursor = page.next_cursor;
+                    document.getElementById('more').style.display = inbox.cursor ? 'inline-block' : 'none';
+                })
+                .catch(function() { box.textContent = '❌ Не удалось загрузить вопросы'; });
+        }
+
+        function buyPremium(payload, amount) {
+            Telegram.WebApp.openInvoice('__BASE_URL__/invoice_' + payload, {
+                title: 'Премиум подписка',
+                description: 'Доступ ко всем функциям бота',
+                currency: 'XTR',
+                prices: [{ label: 'Stars', amount: amount }],
+                payload: payload
+            });
+        }
+
+        Telegram.WebApp.ready();
+        Telegram.WebApp.expand();
+
+        fetch('/api/me', {headers: {'X-Telegram-Init-Data': Telegram.WebApp.initData}})
+            .then(function(r) { if (!r.ok) throw new Error(r.status); return r.json(); })
+            .then(function(me) { render(me); loadInbox('all'); })
+            .catch(function() { document.body.innerHTML = '<h3>❌ Ошибка авторизации</h3><p>Откройте через бота Telegram</p>'; });
+
+        Telegram.WebApp.onEvent('invoiceClosed', function(event) {
+            if (event.status === 'paid') {
+                Telegram.WebApp.showPopup({message: '✅ Оплата прошла успешно!'});
+            }
+        });
+    </script>
+</body>
+</html>
+""".replace("__BASE_URL__", BASE_URL)
+
+class StaticAsset:
+    """Тело, gzip-версия и ETag считаются один раз при старте"""
+
+    def __init__(self, body: str, content_type: str, max_age: int = 86400):
+        self.body = body.encode()
+        self.gzipped = gzip.compress(self.body, compresslevel=9)
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:16]}"'
+        self.content_type = content_type
+        self.cache_control = f"public, max-age={max_age}"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if self.etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return web.Response(body=self.gzipped, content_type=self.content_type, charset="utf-8", headers=headers)
+        return web.Response(body=self.body, content_type=self.content_type, charset="utf-8", headers=headers)
+
+miniapp_shell = StaticAsset(MINIAPP_HTML, "text/html")
+
+def json_response_cached(request: web.Request, payload: dict) -> web.Response:
+    """JSON с ETag: совпал If-None-Match — 304 без тела, иначе сжатый ответ"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    response = web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+    if len(body) > 512:
+        response.enable_compression()
+    return response
+
+@webapp_auth_required
+async def api_me(request: web.Request, user: WebAppUser):
+    # Одна выборка по первичному ключу вместо COUNT(*) по истории
+    stats = await database.fetchone(SQL_USER_STATS, (user.id,))
+    if not stats:
+        return web.json_response({"error": "user_not_found"}, status=404)
+
+    sent, received, answered, badge, theme, accent = stats
+    status = await entitlements.status(user.id)
+    premium_until, trial_until = await entitlements.get(user.id)
+    return json_response_cached(request, {
+        "stats": {"sent": sent, "received": received, "answered": answered, "pending": received - answered},
+        "premium": status == "premium",
+        "premium_until": premium_until if status == "premium" else None,
+        "lifetime": status == "premium" and premium_until >= LIFETIME_UNTIL,
+        "trial": status == "trial",
+        "trial_until": trial_until if status == "trial" else None,
+        "badge": badge,
+        "theme": theme,
+        "accent": accent,
+        # Топ-10 пользователей — из памяти, без запроса к БД
+        "leaderboard": {window: leaderboard.top(window) for window in ("day", "week", "all")},
+    })
+
+INBOX_PAGE_SIZE = 20
+INBOX_START = ("9999-12-31 23:59:59", 2 ** 63 - 1)  # курсор первой страницы
+
+def encode_cursor(sort_key: str, qid: int) -> str:
+    return base64.urlsafe_b64encode(f"{sort_key}|{qid}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """(sort_key, id) из курсора или None, если он испорчен"""
     try:
-        init_data = request.query_string
-        print(f"🔧 MiniApp init_data: {init_data[:100]}...")
-        
-        if not init_data or not verify_telegram_webapp_data(init_data, TOKEN):
-            return web.Response(text="<h3>❌ Ошибка авторизации</h3><p>Откройте через бота Telegram</p>", content_type="text/html")
-
-        # Парсим user данные
-        parsed = parse_qs(init_data)
-        user_str = parsed.get('user', [''])[0]
-        if user_str:
-            user_data = json.loads(user_str)
-            user_id = user_data['id']
+        sort_key, _, qid = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().rpartition("|")
+        return sort_key, int(qid)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+@webapp_auth_required
+async def api_inbox(request: web.Request, user: WebAppUser):
+    """Входящие вопросы страницами: ?filter=all|answered|pending|hidden&cursor=...
+
+    Курсор — последняя отданная строка, поэтому любая страница стоит как первая.
+    Горячая таблица и архив читаются одним и тем же запросом и сливаются.
+    """
+    name = request.query.get("filter", "all")
+    if name not in INBOX_FILTERS:
+        return web.json_response({"error": "bad_filter"}, status=400)
+    position = decode_cursor(request.query["cursor"]) if request.query.get("cursor") else INBOX_START
+    if position is None:
+        return web.json_response({"error": "bad_cursor"}, status=400)
+    try:
+        limit = min(max(int(request.query.get("limit", INBOX_PAGE_SIZE)), 1), 50)
+    except ValueError:
+        return web.json_response({"error": "bad_limit"}, status=400)
+
+    sort_key, qid = position
+    params = (user.id, sort_key, sort_key, qid, limit + 1)
+    async with database.read() as db:
+        rows = await (await db.execute(SQL_INBOX_PAGE[name], params)).fetchall()
+        if name in SQL_INBOX_ARCHIVE:
+            rows += await (await db.execute(SQL_INBOX_ARCHIVE[name], params)).fetchall()
+    rows.sort(key=lambda row: (row[7], row[0]), reverse=True)
+
+    page = rows[:limit]
+    return json_response_cached(request, {
+        "items": [
+            # Лайки — с ещё не записанными дельтами из буфера
+            {"id": qid, "text": text, "answer": answer, "answered": bool(answered), "hidden": bool(hidden),
+             "likes": likes + counter_buffer.pending("likes", qid), "bumped": bool(bumped), "at": at}
+            for qid, text, answer, answered, hidden, likes, bumped, at in page
+        ],
+        "next_cursor": encode_cursor(page[-1][7], page[-1][0]) if len(rows) > limit else None,
+    })
+
+# ==================== УВЕДОМЛЕНИЯ ОБ ОТВЕТАХ ====================
+class TokenBucket:
+    """Глобальный лимит отправки: rate сообщений в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class NotificationDispatcher:
+    """Пуши «тебе ответили»: durable outbox в SQLite + конкурентная отправка с лимитами.
+
+    handle_reply кладёт строки в notify_outbox в транзакции ответа и сразу отдаёт их
+    в очередь. Несколько ответов одному пользователю склеиваются в одно сообщение.
+    Отправленные строки пачкой помечаются notified = 1 и удаляются из outbox.
+    В многопроцессном режиме отправляет только главный процесс — один лимит и один
+    интервал на чат; воркеры пишут outbox и присылают строки по pipe.
+    """
+
+    TEXT = "Тебе ответили на вопрос! Открой бота и посмотри"
+
+    def __init__(self, rate: float = 25, per_chat_interval: float = 1.0, concurrency: int = 16,
+                 flush_interval: float = 1.0, flush_size: int = 200):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.queue = asyncio.Queue()  # chat_id, у которых есть что отправить
+        self.pending = {}  # chat_id -> [(question_id, enqueued_at)]
+        self.last_sent = {}  # chat_id -> время последней отправки
+        self.busy = set()  # chat_id, которые сейчас отправляет какой-то воркер
+        self.queued = set()  # question_id в очереди или ждущие flush
+        self.forward = None  # в воркере: передать строки outbox главному процессу
+        self.done = []  # question_id, ожидающие пакетного UPDATE
+        self.tasks = []
+        self.sent = self.failed = self.retried = self.handled = 0
+        self.latency_total = self.latency_max = 0.0
+
+    async def stage(self, db, answered_rows) -> list:
+        """Внутри транзакции ответа: outbox для тех, у кого включены пуши"""
+        if not answered_rows:
+            return []
+        chat_ids = list({chat_id for _, chat_id in answered_rows})
+        marks = ",".join("?" * len(chat_ids))
+        rows = await (await db.execute(
+            f"SELECT user_id FROM users WHERE user_id IN ({marks}) AND push_answers = 1", chat_ids
+        )).fetchall()
+        push = {user_id for user_id, in rows}
+
+        staged = [(qid, chat_id) for qid, chat_id in answered_rows if chat_id in push]
+        muted = [qid for qid, chat_id in answered_rows if chat_id not in push]
+        if staged:
+            await db.executemany(SQL_OUTBOX_ADD, staged)
+        if muted:
+            marks = ",".join("?" * len(muted))
+            await db.execute(f"UPDATE questions SET notified = 1 WHERE id IN ({marks})", muted)
+        return staged
+
+    def submit(self, items):
+        """После коммита: (question_id, chat_id) в очередь отправки"""
+        if self.forward:
+            self.forward(items)  # воркер: отправляет главный процесс
+            return
+        now = asyncio.get_running_loop().time()
+        for qid, chat_id in items:
+            # Сигнал воркера и повторное чтение outbox могут принести одну строку дважды
+            if qid in self.queued:
+                continue
+            self.queued.add(qid)
+            self._enqueue(chat_id, [(qid, now)])
+
+    def _enqueue(self, chat_id: int, items: list):
+        if chat_id in self.pending:
+            self.pending[chat_id].extend(items)
         else:
-            return web.Response(text="<h3>❌ User data not found</h3>", content_type="text/html")
-
-        print(f"🔧 MiniApp user_id: {user_id}")
-
-        async with aiosqlite.connect(DB) as db:
-            # Статистика пользователя
-            stats = await (await db.execute("""
-                SELECT 
-                    (SELECT COUNT(*) FROM questions WHERE from_user = ?),
-                    (SELECT COUNT(*) FROM questions WHERE to_user = ?),
-                    (SELECT COUNT(*) FROM questions WHERE to_user = ? AND answered = 1),
-                    (SELECT COUNT(*) FROM questions WHERE to_user = ? AND answered = 0),
-                    premium_until, badge, theme, accent_color
-                FROM users WHERE user_id = ?
-            """, (user_id, user_id, user_id, user_id, user_id))).fetchone()
-
-            if not stats:
-                return web.Response(text="<h3>❌ Пользователь не найден</h3>", content_type="text/html")
-
-            sent, received, answered, pending, premium_until, badge, theme, accent = stats
-
-            # Топ-10 пользователей
-            top_rows = await (await db.execute("""
-                SELECT u.username, COUNT(q.id) as cnt
-                FROM questions q
-                JOIN users u ON q.to_user = u.user_id
-                GROUP BY q.to_user
-                ORDER BY cnt DESC
-                LIMIT 10
-            """)).fetchall()
-
-        top_html = ""
-        for i, (username, cnt) in enumerate(top_rows, 1):
-            top_html += f"{i}. @{username or 'аноним'} — {cnt} вопросов<br>"
-
-        badge_html = f"<div style='font-size:28px; margin:15px'>🏆 {badge}</div>" if badge else ""
-
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta name="viewport" content="width=device-width,initial-scale=1">
-            <script src="https://telegram.org/js/telegram-web-app.js"></script>
-            <style>
-                body {{font-family:system-ui; padding:20px; background:var(--tg-theme-bg-color); color:var(--tg-theme-text-color); text-align:center}}
-                .card {{background:var(--tg-theme-secondary-bg-color); border-radius:16px; padding:24px; margin:15px 0}}
-                .num {{font-size:52px; font-weight:800; color:{accent}}}
-                button {{margin:12px 0; padding:18px; width:90%; background:{accent}; color:white; border:none; border-radius:16px; font-size:20px; cursor:pointer}}
-                .top {{font-size:15px; margin-top:30px; line-height:1.8}}
-            </style>
-        </head>
-        <body>
-            <h1>Личный кабинет {badge_html}</h1>
-            
-            <div class="card"><div class="num">{sent}</div>Отправлено вопросов</div>
-            <div class="card"><div class="num">{received}</div>Получено вопросов</div>
-            <div class="card"><div class="num">{answered}</div>Отвечено</div>
-            <div class="card"><div class="num" style="color:#e74c3c">{pending}</div>Ждут ответа</div>
-            <div class="card"><b>Премиум до:</b> {premium_until or "Нет"}</div>
-
-            <button onclick="buyPremium('month', 13500)">135⭐ — 1 месяц</button>
-            <button onclick="buyPremium('3month', 33000)">330⭐ — 3 месяца</button>
-            <button onclick="buyPremium('year', 105000)">1050⭐ — год</button>
-            <button onclick="buyPremium('life', 260000)">2600⭐ — навсегда</button>
-
-            <h3>Топ-10 пользователей</h3>
-            <div class="top">{top_html or "Пока пусто"}</div>
-
-            <script>
-                function buyPremium(payload, amount) {{
-                    Telegram.WebApp.openInvoice('{BASE_URL}/invoice_' + payload, {{
-                        title: 'Премиум подписка',
-                        description: 'Доступ ко всем функциям бота',
-                        currency: 'XTR',
-                        prices: [{{ label: 'Stars', amount: amount }}],
-                        payload: payload
-                    }});
-                }}
-
-                Telegram.WebApp.ready();
-                Telegram.WebApp.expand();
-                
-                Telegram.WebApp.onEvent('invoiceClosed', function(event) {{
-                    if (event.status === 'paid') {{
-                        Telegram.WebApp.showPopup({{message: '✅ Оплата прошла успешно!'}});
-                    }}
-                }});
-            </script>
-        </body>
-        </html>
-        """
-        return web.Response(text=html, content_type="text/html")
-        
-    except Exception as e:
-        print(f"❌ Ошибка в MiniApp: {e}")
-        return web.Response(text=f"<h3>❌ Ошибка сервера: {str(e)}</h3>", content_type="text/html")
+            self.pending[chat_id] = list(items)
+            self.queue.put_nowait(chat_id)
+
+    async def recover(self) -> int:
+        """Всё, что лежит в outbox и ещё не в очереди: после рестарта или падения воркера"""
+        rows = await database.fetchall(SQL_OUTBOX_ALL)
+        fresh = [(qid, chat_id) for qid, chat_id in rows if qid not in self.queued]
+        self.submit(fresh)
+        if fresh:
+            print(f"✅ Outbox: восстановлено {len(fresh)} уведомлений")
+        return len(fresh)
+
+    async def start(self):
+        await self.recover()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self._flusher()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.flush()
+
+    async def _send(self, loop, chat_id: int, items: list) -> bool:
+        """Одна отправка с соблюдением интервала на чат; False — чат ушёл на повтор"""
+        wait = self.last_sent.get(chat_id, 0) + self.per_chat_interval - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.bucket.acquire()
 
-# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
-async def background_tasks():
-    while True:
         try:
-            async with aiosqlite.connect(DB) as db:
-                # Пуш о новых ответах
-                rows = await (await db.execute("""
-                    SELECT DISTINCT from_user FROM questions 
-                    WHERE answered = 1 AND notified = 0
-                """)).fetchall()
-
-                for (uid,) in rows:
-                    user = await (await db.execute("SELECT push_answers FROM users WHERE user_id = ?", (uid,))).fetchone()
-                    if user and user[0]:
-                        try:
-                            await bot.send_message(uid, "Тебе ответили на вопрос! Открой бота и посмотри")
-                        except:
-                            pass
-                    await db.execute("UPDATE questions SET notified = 1 WHERE from_user = ?", (uid,))
-                await db.commit()
-
-            await asyncio.sleep(60)
+            await bot.send_message(chat_id, self.TEXT)
+            self.sent += 1
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: вернём чат в очередь через retry_after
+            self.retried += 1
+            loop.call_later(e.retry_after, self._enqueue, chat_id, items)
+            return False
         except Exception as e:
-            print(f"❌ Ошибка в background_tasks: {e}")
-            await asyncio.sleep(60)
+            # Заблокировал бота и т.п. — повторять бессмысленно
+            self.failed += 1
+            print(f"❌ Пуш {chat_id} не отправлен: {e}")
+        finally:
+            self.last_sent[chat_id] = loop.time()
+        return True
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self.queue.get()
+            # Чат уже отправляет другой воркер — новые элементы остаются в pending,
+            # владелец вернёт чат в очередь, и интервал отсчитается от его отправки
+            if chat_id in self.busy:
+                continue
+            items = self.pending.pop(chat_id, [])
+            if not items:
+                continue
+            self.busy.add(chat_id)
+            try:
+                if not await self._send(loop, chat_id, items):
+                    continue
+            finally:
+                self.busy.discard(chat_id)
+                if chat_id in self.pending:
+                    self.queue.put_nowait(chat_id)
+
+            now = loop.time()
+            self.handled += len(items)
+            for qid, enqueued_at in items:
+                self.done.append(qid)
+                self.latency_total += now - enqueued_at
+                self.latency_max = max(self.latency_max, now - enqueued_at)
+            if len(self.last_sent) > 10000:
+                self.last_sent = {c: t for c, t in self.last_sent.items() if now - t < self.per_chat_interval}
+            if len(self.done) >= self.flush_size:
+                await self.flush()
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Ошибка записи notified: {e}")
+
+    async def flush(self):
+        """Один UPDATE + DELETE на пачку отправленных"""
+        while self.done:
+            ids, self.done = self.done[:500], self.done[500:]
+            marks = ",".join("?" * len(ids))
+            try:
+                async with database.write() as db:
+                    await db.execute(f"UPDATE questions SET notified = 1 WHERE id IN ({marks})", ids)
+                    await db.execute(f"DELETE FROM notify_outbox WHERE question_id IN ({marks})", ids)
+            except Exception:
+                self.done = ids + self.done  # повторим на следующем flush
+                raise
+            self.queued.difference_update(ids)
+
+    def stats(self) -> dict:
+        return {
+            "queue_chats": len(self.pending),
+            "queue_items": sum(len(items) for items in self.pending.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": self.latency_total / self.handled if self.handled else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+notifier = NotificationDispatcher(rate=NOTIFY_RATE)
 
 # ==================== АДМИНКА ====================
 @dp.message(Command("admin"))
@@ -515,36 +2253,936 @@ async def admin_panel(m: types.Message):
     if m.from_user.id != OWNER_ID:
         return await m.answer("❌ Доступ запрещен")
     
-    async with aiosqlite.connect(DB) as db:
-        total_users = (await (await db.execute("SELECT COUNT(*) FROM users")).fetchone())[0]
-        premium_users = (await (await db.execute("SELECT COUNT(*) FROM users WHERE premium_until > datetime('now')")).fetchone())[0]
-        total_questions = (await (await db.execute("SELECT COUNT(*) FROM questions")).fetchone())[0]
-        total_payments = (await (await db.execute("SELECT COALESCE(SUM(amount), 0) FROM payments")).fetchone())[0]
+    # Готовые агрегаты вместо COUNT(*)/SUM() по всей истории
+    week_ago = (datetime.now(timezone.utc) - timedelta(days=6)).strftime("%Y-%m-%d")
+    async with database.read() as db:
+        counters = dict(await (await db.execute(SQL_COUNTERS)).fetchall())
+        premium_users = (await (await db.execute(SQL_COUNT_PREMIUM, (int(time.time()),))).fetchone())[0]
+        revenue = await (await db.execute(SQL_REVENUE_REPORT, (week_ago,))).fetchall()
+    total_users = counters.get("users", 0)
+    total_questions = counters.get("questions", 0)
+    total_payments = sum(stars for kind, _, _, stars in revenue if kind == "total")
+    week_payments = sum(stars for kind, _, _, stars in revenue if kind == "day")
+    by_payload = ", ".join(
+        f"{key or '—'} {count}×/{stars}⭐"
+        for kind, key, count, stars in sorted(revenue, key=lambda r: -r[3]) if kind == "payload"
+    )
+    push = notifier.stats()
+    names = usernames.stats()
+    ents = entitlements.stats()
+    ingest = updates.stats()
+    buffered = counter_buffer.stats()
     
     await m.answer(
         f"📊 Статистика бота:\n\n"
         f"👥 Пользователей: {total_users}\n"
         f"⭐ Премиум: {premium_users}\n"
         f"❓ Вопросов: {total_questions}\n"
-        f"💰 Звёзд получено: {total_payments}⭐\n"
-        f"💵 Примерный доход: {total_payments * 0.007:.2f}€"
+        f"💰 Звёзд получено: {total_payments}⭐ (за 7 дней: {week_payments}⭐)\n"
+        f"💵 Примерный доход: {total_payments * 0.007:.2f}€\n"
+        f"🧾 По товарам: {by_payload or '—'}\n\n"
+        f"🔔 Очередь пушей: {push['queue_items']} ({push['queue_chats']} чатов)\n"
+        f"📨 Отправлено: {push['sent']} | ошибок: {push['failed']} | 429: {push['retried']}\n"
+        f"⏱ Задержка: ср. {push['latency_avg']:.2f}с, макс. {push['latency_max']:.2f}с\n"
+        f"🔎 Кэш username: {names['size']} | попаданий {names['hits']}, "
+        f"пустых {names['negative_hits']}, промахов {names['misses']}, устаревших {names['stale']}\n"
+        f"⭐ Кэш премиумов: {ents['size']} | попаданий {ents['hits']}, "
+        f"промахов {ents['misses']}, перечитано {ents['refreshed']}\n"
+        f"📥 Апдейты: в очереди {ingest['depth']}, обработано {ingest['processed']}, "
+        f"дублей {ingest['duplicates']}, отказов {ingest['rejected']}, ошибок {ingest['errors']}\n"
+        f"⏱ Ожидание: ср. {ingest['wait_avg']:.3f}с, макс. {ingest['wait_max']:.3f}с | "
+        f"обработка: ср. {ingest['handle_avg']:.3f}с, макс. {ingest['handle_max']:.3f}с\n"
+        f"🗄 Архив: всего перенесено {archiver.moved}; последний прогон — {archiver.report or 'ещё не было'}\n"
+        f"🧮 Буфер счётчиков: ждут {buffered['pending']}, лайков {buffered['added']}, транзакций {buffered['flushes']}"
+    )
+
+# ==================== ПРИЁМ АПДЕЙТОВ ====================
+def update_user_id(update: dict) -> int:
+    """Ключ упорядочивания апдейта: from.id, иначе user/chat id"""
+    for payload in update.values():
+        if isinstance(payload, dict):
+            user = payload.get("from") or payload.get("user") or payload.get("chat") or {}
+            if "id" in user:
+                return user["id"]
+    return 0
+
+class UpdateQueue:
+    """Вебхук отвечает Telegram сразу, апдейт уходит в ограниченную очередь.
+
+    Пул задач обрабатывает апдейты конкурентно, но апдейты одного пользователя —
+    строго по очереди: пока чат занят, новые апдейты копятся за ним и
+    обрабатываются той же задачей. Повторы от Telegram отсекаются по update_id.
+    """
+
+    def __init__(self, maxsize: int = 10000, concurrency: int = 32, dedup_size: int = 20000):
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self.dedup_size = dedup_size
+        self.queue = asyncio.Queue()
+        self.active = {}  # user_id -> deque апдейтов, ждущих занятый чат
+        self.seen = OrderedDict()  # недавние update_id
+        self.depth = 0  # в очереди + ждут своего чата + в обработке
+        self.not_full = asyncio.Event()
+        self.tasks = []
+        self.received = self.duplicates = self.rejected = self.processed = self.errors = 0
+        self.wait_total = self.wait_max = self.handle_total = self.handle_max = 0.0
+
+    def put(self, update: dict) -> bool:
+        """False — очередь полна, пусть Telegram повторит позже"""
+        update_id = update.get("update_id")
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        if self.depth >= self.maxsize:
+            self.rejected += 1
+            return False
+        self.seen[update_id] = None
+        if len(self.seen) > self.dedup_size:
+            self.seen.popitem(last=False)
+        self.received += 1
+        self.depth += 1
+        self.queue.put_nowait((update, asyncio.get_running_loop().time()))
+        return True
+
+    async def put_wait(self, update: dict):
+        """Для воркеров за pipe: вместо отказа ждём свободного места"""
+        while not self.put(update):
+            self.not_full.clear()
+            await self.not_full.wait()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not self.put(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 10):
+        """Дорабатываем принятое (не дольше timeout) и гасим пул"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.depth and self.tasks and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _worker(self):
+        while True:
+            update, enqueued_at = await self.queue.get()
+            key = update_user_id(update)
+            if key in self.active:
+                self.active[key].append((update, enqueued_at))
+                continue
+            backlog = self.active[key] = deque()
+            try:
+                item = (update, enqueued_at)
+                while item:
+                    await self._process(*item)
+                    item = backlog.popleft() if backlog else None
+            finally:
+                del self.active[key]
+
+    async def _process(self, update: dict, enqueued_at: float):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ Ошибка обработки апдейта {update.get('update_id')}: {e}")
+        finally:
+            finished = loop.time()
+            self.processed += 1
+            self.wait_total += started - enqueued_at
+            self.wait_max = max(self.wait_max, started - enqueued_at)
+            self.handle_total += finished - started
+            self.handle_max = max(self.handle_max, finished - started)
+            self.depth -= 1
+            self.not_full.set()
+
+    def stats(self) -> dict:
+        done = self.processed or 1
+        return {
+            "depth": self.depth,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "errors": self.errors,
+            "wait_avg": self.wait_total / done,
+            "wait_max": self.wait_max,
+            "handle_avg": self.handle_total / done,
+            "handle_max": self.handle_max,
+        }
+
+updates = UpdateQueue(maxsize=UPDATE_QUEUE_SIZE, concurrency=UPDATE_CONCURRENCY)
+
+# ==================== МНОГОПРОЦЕССНЫЙ РЕЖИМ ====================
+class ShardRouter:
+    """Главный процесс принимает /webhook и раздаёт апдейты воркерам по user_id.
+
+    Апдейты одного пользователя всегда попадают в один и тот же воркер и идут
+    по одному pipe в порядке поступления; разные пользователи обрабатываются
+    параллельно в разных процессах. Синглтоны (отправка пушей из outbox, рендер
+    PDF, очистка FSM, webhook, Mini App) остаются в главном процессе.
+    """
+
+    def __init__(self, workers: int, queue_size: int = 1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ctx = multiprocessing.get_context("spawn")
+        # Очереди есть с самого начала — вебхуки копятся в них, пока идёт прогрев
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.procs = [None] * workers
+        self.conns = [None] * workers
+        self.metric_conns = [None] * workers
+        self.tasks = []
+        self.collectors = []
+        self.executor = None
+        self.closing = False
+
+    def _spawn(self, index: int):
+        reader, writer = self.ctx.Pipe(duplex=False)
+        # Обратный канал (MainLink) — метрики воркера, пуши и экспорты для главного процесса
+        metrics_reader, metrics_writer = self.ctx.Pipe(duplex=False)
+        proc = self.ctx.Process(
+            target=worker_main, args=(index, reader, metrics_writer), name=f"worker-{index}", daemon=True
+        )
+        proc.start()
+        reader.close()
+        metrics_writer.close()
+        self.procs[index], self.conns[index] = proc, writer
+        self.metric_conns[index] = metrics_reader
+
+    async def start(self):
+        # Поток на отправку и поток на приём метрик для каждого воркера: pipe блокирует
+        self.executor = ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="shard")
+        for index in range(self.workers):
+            self._spawn(index)
+            self.tasks.append(asyncio.create_task(self._sender(index)))
+            self.collectors.append(asyncio.create_task(self._collector(index)))
+        self.tasks.append(asyncio.create_task(self._monitor()))
+        print(f"✅ Запущено воркеров: {self.workers}")
+
+    async def handle(self, request: web.Request) -> web.Response:
+        data = await request.read()
+        try:
+            update = json.loads(data)
+        except ValueError:
+            return web.Response(status=400)
+        if self.closing:
+            return web.Response(status=503)  # Telegram повторит доставку после рестарта
+        index = update_user_id(update) % self.workers
+        # Полная очередь шарда притормаживает ответ Telegram — естественный backpressure
+        await self.queues[index].put(data)
+        return web.Response()
+
+    async def _sender(self, index: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await self.queues[index].get()
+            while True:
+                try:
+                    await loop.run_in_executor(self.executor, self.conns[index].send_bytes, data)
+                    break
+                except (OSError, ValueError):
+                    # Воркер упал — ждём, пока монитор поднимет новый
+                    await asyncio.sleep(0.5)
+            self.queues[index].task_done()
+
+    async def _collector(self, index: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = self.metric_conns[index]
+            try:
+                data = await loop.run_in_executor(self.executor, conn.recv_bytes)
+            except (EOFError, OSError):
+                if self.closing:
+                    return  # воркер вышел, всё присланное им разобрано
+                # Воркер упал — монитор подменит pipe вместе с процессом
+                await asyncio.sleep(0.5)
+                continue
+            kind, payload = json.loads(data)
+            try:
+                if kind == "metrics":
+                    metrics.remote[f"worker-{index}"] = payload
+                elif kind == "notify":
+                    notifier.submit(payload)
+                elif kind == "export":
+                    await exporter.submit(*payload)
+            except Exception as e:
+                print(f"❌ Сообщение воркера {index} ({kind}) не обработано: {e}")
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(2)
+            for index, proc in enumerate(self.procs):
+                if not proc.is_alive():
+                    print(f"❌ Воркер {index} завершился (код {proc.exitcode}) — перезапуск")
+                    self.conns[index].close()
+                    self.metric_conns[index].close()
+                    self._spawn(index)
+                    # Пуши, записанные упавшим воркером, но не дошедшие по pipe
+                    try:
+                        await notifier.recover()
+                    except Exception as e:
+                        print(f"❌ Outbox после падения воркера {index}: {e}")
+
+    async def stop(self, _, timeout: float = 10):
+        """Отдаём воркерам всё принятое (не дольше timeout), затем закрываем pipe"""
+        self.closing = True
+        if self.executor is None:
+            return  # прогрев не дошёл до запуска воркеров
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не переданы воркерам: {sum(queue.qsize() for queue in self.queues)} апдейтов")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Закрытый pipe — сигнал воркеру доработать и выйти
+        for conn in self.conns:
+            conn.close()
+        for proc in self.procs:
+            await asyncio.get_running_loop().run_in_executor(self.executor, proc.join, 10)
+            if proc.is_alive():
+                proc.terminate()
+        # Сборщики дочитывают то, что воркеры прислали перед выходом, до EOF
+        try:
+            await asyncio.wait_for(asyncio.gather(*self.collectors), timeout)
+        except asyncio.TimeoutError:
+            for task in self.collectors:
+                task.cancel()
+        for conn in self.metric_conns:
+            conn.close()
+        self.executor.shutdown(wait=False)
+
+class MainLink:
+    """Воркер → главный процесс: [вид, данные] в JSON по одному pipe.
+
+    Пишет один таск, поэтому сообщения не перемешиваются, а send из хендлера
+    не блокирует event loop.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def send(self, kind: str, payload):
+        self.queue.put_nowait((kind, payload))
+
+    async def start(self):
+        self.task = asyncio.create_task(self._sender())
+
+    async def stop(self, timeout: float = 5):
+        """Дописывает накопленное (не дольше timeout) и останавливает отправку"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не переданы главному процессу: {self.queue.qsize()} сообщений")
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _sender(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, payload = await self.queue.get()
+            try:
+                await loop.run_in_executor(None, self.conn.send_bytes, json.dumps([kind, payload]).encode())
+            except (OSError, ValueError):
+                return  # главный процесс закрыл pipe — пуши подберёт outbox
+            finally:
+                self.queue.task_done()
+
+def worker_main(index: int, conn, metrics_conn):
+    """Точка входа дочернего процесса"""
+    # Останавливает воркеры главный процесс — закрытием pipe, а не сигналом
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(index, conn, metrics_conn))
+
+async def run_worker(index: int, conn, metrics_conn):
+    await database.open()
+    await leaderboard.load()
+    await usernames.warm()
+    await entitlements.warm()
+    asyncio.create_task(entitlements.sweeper())
+    # Кэш FSM живёт в процессе, который обрабатывает апдейты, — чистим его здесь;
+    # DELETE в общем файле идемпотентен, главный процесс делает то же самое
+    asyncio.create_task(fsm_storage.sweeper())
+    link = MainLink(metrics_conn)
+    await link.start()
+    asyncio.create_task(metrics.loop_lag())
+    asyncio.create_task(metrics.reporter(link))
+    # Пуши отправляет главный процесс: воркер только пишет outbox и даёт сигнал
+    notifier.forward = lambda items: link.send("notify", items)
+    exporter.forward = lambda user_id, chat_id: link.send("export", (user_id, chat_id))
+    await counter_buffer.start()
+    await updates.start()
+    print(f"✅ Воркер {index} готов (pid {os.getpid()})")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, conn.recv_bytes)
+            except (EOFError, OSError):
+                break
+            await updates.put_wait(json.loads(data))
+    finally:
+        await updates.stop()
+        await counter_buffer.stop()
+        await link.stop()
+        await fsm_storage.close()
+        await database.close()
+        await bot.session.close()
+
+shards = ShardRouter(WORKERS) if WORKERS > 1 else None
+
+# ==================== ЭКСПОРТ В PDF ====================
+def render_questions_pdf(db_path: str, archive_path: str, user_id: int, out_path: str, chunk: int = 500) -> int:
+    """Выполняется в пуле процессов: курсором читает историю и пишет PDF постранично"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+
+    font = "Helvetica"
+    if os.path.exists(PDF_FONT):
+        pdfmetrics.registerFont(TTFont("ExportFont", PDF_FONT))
+        font = "ExportFont"
+
+    width, height = A4
+    margin, line_height, size = 50, 14, 10
+    text_width = width - 2 * margin
+
+    # Страницы сжимаются сразу после showPage — в памяти не копятся сырые потоки
+    tmp_path = out_path + ".tmp"
+    c = canvas.Canvas(tmp_path, pagesize=A4, pageCompression=1)
+    c.setTitle("Анонимные вопросы")
+    y = height - margin
+
+    def line(text: str, font_size: int = size):
+        nonlocal y
+        if y < margin:
+            c.showPage()
+            y = height - margin
+        c.setFont(font, font_size)
+        c.drawString(margin, y, text)
+        y -= line_height
+
+    line("Ваши вопросы и ответы", 16)
+    y -= line_height
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    count = 0
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (f"file:{archive_path}?mode=ro",))
+        conn.execute(SQL_QUESTIONS_ALL_VIEW)
+        cur = conn.execute(SQL_EXPORT_QUESTIONS, (user_id,))
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            for qid, text, answer, created_at in rows:
+                count += 1
+                line(f"#{count} · {created_at}", 8)
+                for part in simpleSplit(f"Вопрос: {text or ''}", font, size, text_width):
+                    line(part)
+                for part in simpleSplit(f"Ответ: {answer or '—'}", font, size, text_width):
+                    line(part)
+                y -= line_height / 2
+    finally:
+        conn.close()
+
+    c.save()
+    os.replace(tmp_path, out_path)
+    return count
+
+class PdfExporter:
+    """Очередь экспортов: рендер в пуле процессов с ограничением параллельности.
+
+    Готовый файл кэшируется на диске по числу полученных и отвеченных вопросов,
+    пока не придут новые. Повторный заказ во время рендера ждёт тот же файл.
+    Воркеры — daemon-процессы и не могут заводить пул, поэтому в многопроцессном
+    режиме рендерит главный процесс, а воркер только передаёт ему заказ.
+    """
+
+    def __init__(self, directory: str, concurrency: int = 2):
+        self.directory = directory
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        self.waiting = {}  # user_id -> [chat_id, ...] ждущих текущий рендер
+        self.pool = None
+        self.tasks = []
+        self.forward = None  # в воркере: передать заказ главному процессу
+
+    async def submit(self, user_id: int, chat_id: int):
+        if self.forward:
+            self.forward(user_id, chat_id)
+            return
+        if user_id in self.waiting:
+            self.waiting[user_id].append(chat_id)
+            return
+        self.waiting[user_id] = [chat_id]
+        await self.queue.put(user_id)
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self._warm()))
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.concurrency, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self.pool
+
+    async def _warm(self):
+        """Поднимаем процессы пула заранее: spawn заново импортирует main.py, и под
+        нагрузкой первые оплаченные экспорты ждали бы этого дольше, чем сам рендер"""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self._pool(), os.getpid) for _ in range(self.concurrency)))
+        except Exception as e:
+            print(f"⚠️ Пул PDF не прогрет: {e}")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def _worker(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                path = await self.export(user_id)
+            except Exception as e:
+                path = None
+                print(f"❌ Ошибка экспорта PDF для {user_id}: {e}")
+            for chat_id in self.waiting.pop(user_id, []):
+                try:
+                    if path:
+                        await bot.send_document(
+                            chat_id, FSInputFile(path, filename="questions.pdf"),
+                            caption="✅ Ваш PDF с вопросами и ответами!"
+                        )
+                    else:
+                        await bot.send_message(chat_id, "❌ Не удалось собрать PDF. Напишите в поддержку — пришлём файл вручную")
+                except Exception as e:
+                    print(f"❌ PDF не доставлен {chat_id}: {e}")
+
+    async def export(self, user_id: int) -> str:
+        row = await database.fetchone("SELECT received, answered FROM user_stats WHERE user_id = ?", (user_id,))
+        received, answered = row or (0, 0)
+        path = os.path.join(self.directory, f"{user_id}-{received}-{answered}.pdf")
+        if os.path.exists(path):
+            return path
+
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(self._pool(), render_questions_pdf, DB, ARCHIVE_DB, user_id, path)
+        print(f"✅ PDF для {user_id}: {count} вопросов")
+
+        # Старые версии файла больше не нужны
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{user_id}-") and os.path.join(self.directory, name) != path:
+                os.remove(os.path.join(self.directory, name))
+        return path
+
+exporter = PdfExporter(EXPORT_DIR, concurrency=EXPORT_CONCURRENCY)
+
+# ==================== АРХИВ ВОПРОСОВ ====================
+SQL_ARCHIVE_BATCH = "SELECT id, created_at FROM main.questions WHERE id > ? ORDER BY id LIMIT ?"
+SQL_ARCHIVE_COPY = f"""
+    INSERT OR REPLACE INTO archive.questions ({QUESTION_COLUMNS})
+    SELECT {QUESTION_COLUMNS} FROM main.questions
+    WHERE id > ? AND id <= ? AND answered = 1 AND notified = 1 AND created_at < ?
+"""
+# Доставки архивных вопросов ни к чему не ведут (SQL_FIND_DELIVERY смотрит в main)
+SQL_ARCHIVE_DELIVERIES = """
+    DELETE FROM deliveries WHERE question_id IN (
+        SELECT id FROM main.questions
+        WHERE id > ? AND id <= ? AND answered = 1 AND notified = 1 AND created_at < ?
+    )
+"""
+SQL_ARCHIVE_DELETE = """
+    DELETE FROM main.questions
+    WHERE id > ? AND id <= ? AND answered = 1 AND notified = 1 AND created_at < ?
+"""
+# Лидерборд читает только последние WINDOW_DAYS дней — старые строки удаляем пачками
+SQL_PRUNE_DAILY = """
+    DELETE FROM received_daily WHERE (user_id, day) IN (
+        SELECT user_id, day FROM received_daily WHERE day < ? LIMIT ?
     )
+"""
+SQL_HOT_TABLE_BYTES = """
+    SELECT SUM(pgsize) FROM dbstat
+    WHERE schema = 'main' AND aggregate = 1
+    AND name IN (SELECT name FROM main.sqlite_master WHERE tbl_name = 'questions')
+"""
+
+def format_mb(size) -> str:
+    return "?" if size is None else f"{size / 1048576:.1f}"
+
+class Archiver:
+    """Переносит отвеченные и доставленные вопросы старше age_days в файл архива.
+
+    Идёт по rowid пачками по batch строк: каждая пачка — короткая транзакция
+    писателя, между ними обработчики пишут как обычно. Освободившиеся страницы
+    incremental_vacuum возвращает файлу тоже порциями. Работает в главном процессе.
+    """
+
+    def __init__(self, age_days: int = 90, interval: float = 3600, batch: int = 500,
+                 vacuum_pages: int = 2000, pause: float = 0.05):
+        self.age_days = age_days
+        self.interval = interval
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.task = None
+        self.moved = 0
+        self.report = None  # итог последнего прогона для админки
+
+    async def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _loop(self):
+        await asyncio.sleep(60)  # не мешаем прогреву кэшей после старта
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                print(f"❌ Ошибка архивации: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run(self) -> int:
+        before = await self.sizes()
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.age_days)).strftime("%Y-%m-%d %H:%M:%S")
+        moved, last_id = 0, 0
+        while True:
+            rows = await database.fetchall(SQL_ARCHIVE_BATCH, (last_id, self.batch))
+            if not rows:
+                break
+            first, last_id = last_id, rows[-1][0]
+            # Между файлами WAL атомарности не даёт: после сбоя строка может остаться
+            # в обоих — следующий прогон перезапишет копию в архиве и удалит оригинал
+            async with database.write() as db:
+                await db.execute(SQL_ARCHIVE_COPY, (first, last_id, cutoff))
+                await db.execute(SQL_ARCHIVE_DELIVERIES, (first, last_id, cutoff))
+                cur = await db.execute(SQL_ARCHIVE_DELETE, (first, last_id, cutoff))
+                moved += cur.rowcount
+            # id растут вместе с created_at — дальше только свежие вопросы
+            if rows[-1][1] >= cutoff:
+                break
+            await asyncio.sleep(self.pause)
+
+        pruned = await self.prune_daily()
+        freed = await self.vacuum() if moved or pruned else 0
+        after = await self.sizes()
+        self.moved += moved
+        metrics.inc("bot_archived_questions_total", (), moved)
+        if after["table_bytes"] is not None:
+            metrics.set("sqlite_hot_questions_bytes", (), after["table_bytes"])
+        self.report = (
+            f"перенесено {moved}, старых дней лидерборда {pruned}, освобождено {freed} стр. | questions: "
+            f"{before['rows']}→{after['rows']} строк, "
+            f"{format_mb(before['table_bytes'])}→{format_mb(after['table_bytes'])} МБ | "
+            f"файл {format_mb(before['file_bytes'])}→{format_mb(after['file_bytes'])} МБ"
+        )
+        print(f"🗄 Архив: {self.report}")
+        return moved
+
+    async def prune_daily(self) -> int:
+        """Удаляет дни received_daily за пределами окна лидерборда (date('now') в SQLite тоже UTC)"""
+        oldest = (datetime.now(timezone.utc) - timedelta(days=Leaderboard.WINDOW_DAYS - 1)).strftime("%Y-%m-%d")
+        pruned = 0
+        while True:
+            async with database.write() as db:
+                cur = await db.execute(SQL_PRUNE_DAILY, (oldest, self.batch * 10))
+            pruned += cur.rowcount
+            if cur.rowcount < self.batch * 10:
+                return pruned
+            await asyncio.sleep(self.pause)
+
+    async def vacuum(self) -> int:
+        """incremental_vacuum порциями по vacuum_pages, не держа писателя надолго"""
+        freed = 0
+        while True:
+            async with database.write() as db:
+                pages, = await (await db.execute("PRAGMA main.freelist_count")).fetchone()
+                # Прагма освобождает по странице на шаг — дочитываем курсор до конца
+                await (await db.execute(f"PRAGMA main.incremental_vacuum({self.vacuum_pages})")).fetchall()
+                left, = await (await db.execute("PRAGMA main.freelist_count")).fetchone()
+            freed += pages - left
+            if not left or left >= pages:
+                return freed
+            await asyncio.sleep(self.pause)
+
+    async def sizes(self) -> dict:
+        async with database.read() as db:
+            rows, = await (await db.execute("SELECT COUNT(*) FROM main.questions")).fetchone()
+            page_size, = await (await db.execute("PRAGMA main.page_size")).fetchone()
+            pages, = await (await db.execute("PRAGMA main.page_count")).fetchone()
+            try:
+                table_bytes, = await (await db.execute(SQL_HOT_TABLE_BYTES)).fetchone()
+            except sqlite3.OperationalError:
+                table_bytes = None  # SQLite собран без dbstat
+        return {"rows": rows, "table_bytes": table_bytes, "file_bytes": pages * page_size}
+
+archiver = Archiver(ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL)
 
 # ==================== ЗАПУСК БОТА ====================
-async def on_startup(_):
+class Startup:
+    """Прогрев после того, как сервер уже слушает порт.
+
+    Вебхуки принимаются сразу и копятся в очереди апдейтов, обработчики
+    запускаются последним шагом, когда база и кэши готовы. Время каждого
+    шага пишется в лог и отдаётся в /readyz.
+    """
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.phases = {}  # шаг -> секунды
+        self.task = None
+        self.error = None
+
+    async def step(self, name: str, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    async def run(self, warm_up):
+        start = time.perf_counter()
+        try:
+            await warm_up()
+        except Exception as e:
+            # Без базы апдейты всё равно не обработать — пусть хостинг перезапустит процесс
+            self.error = repr(e)
+            print(f"❌ Прогрев не удался: {e}")
+            signal.raise_signal(signal.SIGTERM)
+            return
+        self.ready.set()
+        steps = ", ".join(f"{name} {seconds:.2f}" for name, seconds in self.phases.items())
+        print(f"✅ Готов к работе за {time.perf_counter() - start:.2f}с ({steps})")
+
+startup = Startup()
+
+async def ensure_webhook():
+    """setWebhook — только если Telegram сейчас шлёт апдейты не сюда.
+
+    Сверяемся с getWebhookInfo, а не с тем, что ставили сами: вебхук могли
+    удалить или перенаправить снаружи (другой деплой, ручной deleteWebhook).
+    """
+    if not (BASE_URL and "http" in BASE_URL):
+        return
+    url = f"{BASE_URL}/webhook"
+    info = await bot.get_webhook_info()
+    if info.url == url:
+        print(f"✅ Webhook не изменился: {url}")
+        return
+    await bot.set_webhook(url)
+    print(f"✅ Webhook установлен: {url}" + (f" (был {info.url})" if info.url else ""))
+
+async def open_database():
+    await database.open()
     await init_db()
-    if BASE_URL and "http" in BASE_URL:
-        await bot.set_webhook(f"{BASE_URL}/webhook")
-        print(f"✅ Webhook установлен: {BASE_URL}/webhook")
-    asyncio.create_task(background_tasks())
-    print("🚀 ТОП-1 АНОНИМНЫЙ БОТ 2025 ГОДА УСПЕШНО ЗАПУЩЕН!")
-    print(f"✅ Все платежи будут поступать на ID: {OWNER_ID}")
-    print("📊 Пользователей онлайн: 68к+ | Доход: 400к+ ₽/мес")
-
-app = web.Application()
-app.router.add_get("/miniapp", miniapp_handler)
-SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/webhook")
+
+async def warn_query_plans():
+    async with database.read() as db:
+        for problem in await check_query_plans(db):
+            print(f"⚠️ Горячий запрос без индекса — {problem}")
+
+async def start_services():
+    await counter_buffer.start()
+    await notifier.start()
+    await exporter.start()
+    await referrals.start()
+    await archiver.start()
+    # Воркеры стартуют после миграций и восстановления outbox в главном процессе
+    if shards:
+        await shards.start()
+    else:
+        await updates.start()
+    asyncio.create_task(fsm_storage.sweeper())
+    asyncio.create_task(entitlements.sweeper())
+    asyncio.create_task(metrics.loop_lag())
+    if shards:
+        asyncio.create_task(leaderboard.refresher())
+
+async def warm_up(serve: bool = True):
+    await startup.step("database", open_database())
+    # Независимые шаги — параллельно: setWebhook ждёт сеть, кэши — читателей
+    await asyncio.gather(
+        startup.step("query_plans", warn_query_plans()),
+        startup.step("leaderboard", leaderboard.load()),
+        startup.step("usernames", usernames.warm()),
+        startup.step("entitlements", entitlements.warm()),
+        *([startup.step("webhook", ensure_webhook())] if serve else []),
+    )
+    if serve:
+        await startup.step("services", start_services())
+        print("🚀 ТОП-1 АНОНИМНЫЙ БОТ 2025 ГОДА УСПЕШНО ЗАПУЩЕН!")
+        print(f"✅ Все платежи будут поступать на ID: {OWNER_ID}")
+        print("📊 Пользователей онлайн: 68к+ | Доход: 400к+ ₽/мес")
+
+async def on_startup(_):
+    # Не ждём прогрева: порт открывается сразу, первый вебхук не упирается в таймаут
+    startup.task = asyncio.create_task(startup.run(warm_up))
+
+async def on_shutdown(_):
+    # Вебхуки, принятые во время прогрева, уже подтверждены Telegram — даём
+    # прогреву дойти до запуска обработчиков, чтобы очередь было кому разобрать
+    if startup.task and not startup.task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(startup.task), 60)
+        except asyncio.TimeoutError:
+            print("⚠️ Прогрев не завершился за 60с — принятые апдейты потеряны")
+
+async def on_cleanup(_):
+    if startup.task and not startup.task.done():
+        startup.task.cancel()
+        await asyncio.gather(startup.task, return_exceptions=True)
+    await updates.stop()
+    await counter_buffer.stop()
+    await referrals.stop()
+    await archiver.stop()
+    await notifier.stop()
+    await exporter.stop()
+    await fsm_storage.close()
+    await database.close()
+    await bot.session.close()
+
+async def healthz(request: web.Request) -> web.Response:
+    """Процесс жив и принимает запросы — даже если прогрев ещё идёт"""
+    return web.Response(text="ok")
+
+async def readyz(request: web.Request) -> web.Response:
+    ready = startup.ready.is_set()
+    body = {
+        "ready": ready,
+        "phases": {name: round(seconds, 3) for name, seconds in startup.phases.items()},
+        "queued_updates": updates.stats()["depth"],
+    }
+    if startup.error:
+        body["error"] = startup.error
+    return web.json_response(body, status=200 if ready else 503)
+
+@web.middleware
+async def wait_ready(request: web.Request, handler):
+    """API Mini App во время прогрева ждёт его (до 10 с), а не падает на закрытой базе"""
+    if request.path.startswith("/api/") and not startup.ready.is_set():
+        try:
+            await asyncio.wait_for(startup.ready.wait(), 10)
+        except asyncio.TimeoutError:
+            return web.json_response({"error": "starting"}, status=503)
+    return await handler(request)
+
+app = web.Application(middlewares=[http_metrics, wait_ready])
+app.router.add_get("/miniapp", miniapp_shell.handle)
+app.router.add_get("/api/me", api_me)
+app.router.add_get("/api/inbox", api_inbox)
+app.router.add_get("/metrics", metrics_handler)
+app.router.add_get("/healthz", healthz)
+app.router.add_get("/readyz", readyz)
 app.on_startup.append(on_startup)
+app.on_shutdown.append(on_shutdown)
+app.on_cleanup.append(on_cleanup)
+if shards:
+    app.router.add_post("/webhook", shards.handle)
+    app.on_cleanup.insert(0, shards.stop)
+else:
+    app.router.add_post("/webhook", updates.handle)
+
+async def rebuild_stats_cli() -> int:
+    """python main.py rebuild-stats — пересчёт счётчиков кабинета и агрегатов админки"""
+    await database.open()
+    try:
+        await init_db()
+        async with database.write() as db:
+            for statement in split_sql(SQL_REBUILD_STATS + SQL_REBUILD_TOTALS):
+                await db.execute(statement)
+        users, = await database.fetchone("SELECT COUNT(*) FROM user_stats")
+    finally:
+        await database.close()
+    print(f"✅ Счётчики пересобраны для {users} пользователей")
+    return 0
+
+async def check_plans_cli() -> int:
+    """python main.py check-plans — проверка, что горячие запросы идут по индексам"""
+    await database.open()
+    try:
+        await init_db()
+        async with database.read() as db:
+            problems = await check_query_plans(db)
+    finally:
+        await database.close()
+    for problem in problems:
+        print(f"❌ {problem}")
+    if not problems:
+        print(f"✅ Все {len(HOT_QUERIES)} горячих запросов используют индексы")
+    return 1 if problems else 0
+
+def profile_imports(top: int = 12) -> list:
+    """Время импорта по пакетам: python -X importtime в отдельном процессе"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    totals = {}
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # Прямые импорты main.py идут с отступом в один уровень
+        name = parts[2]
+        if len(name) - len(name.lstrip()) == 3:
+            package = name.strip().split(".")[0]
+            totals[package] = totals.get(package, 0) + int(parts[1]) / 1e6
+        elif name.strip() == "main":
+            totals["(всего)"] = int(parts[1]) / 1e6
+    return sorted(totals.items(), key=lambda item: -item[1])[:top]
+
+async def profile_startup_cli() -> int:
+    """python main.py profile-startup — импорт по пакетам и каждый шаг прогрева, без вебхука"""
+    print("⏱ Импорт:")
+    for package, seconds in profile_imports():
+        print(f"   {package:<24} {seconds:7.3f}с")
+    try:
+        await warm_up(serve=False)
+    finally:
+        await database.close()
+    print("⏱ Прогрев:")
+    for name, seconds in startup.phases.items():
+        print(f"   {name:<24} {seconds:7.3f}с")
+    return 0
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["check-plans"]:
+        sys.exit(asyncio.run(check_plans_cli()))
+    if sys.argv[1:2] == ["rebuild-stats"]:
+        sys.exit(asyncio.run(rebuild_stats_cli()))
+    if sys.argv[1:2] == ["profile-startup"]:
+        sys.exit(asyncio.run(profile_startup_cli()))
     web.run_app(app, host="0.0.0.0", port=int(os.getenv("PORT", 10000)))